@@ -0,0 +1,177 @@
+# pyRESTvk/benchmark/benchmark.py
+# Dan Allongo (daniel.s.allongo@gmail.com)
+
+# Benchmark suite for the hot paths of server.py. The server is set up in-process with the
+# 'recording' key backend and zero key duration, so it runs on any machine and only measures
+# the server itself. Requests are driven through the flask test client and over a real socket.
+# Results are printed and written as JSON (ie, python benchmark.py results.json).
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import threading
+import httplib
+import socket
+import base64
+
+here = os.path.dirname(os.path.abspath(sys.argv[0]))
+sys.path.insert(0, os.path.join(here, '..'))
+output_file = sys.argv[1] if len(sys.argv) > 1 else 'benchmark-results.json'
+
+# server is configured from a throwaway settings file so the user's profiles are never touched
+work_dir = tempfile.mkdtemp(prefix='pyRESTvk-benchmark-')
+os.environ['APPDATA'] = work_dir
+settings_file = os.path.join(work_dir, 'settings.json')
+password = 'benchmark'
+with open(settings_file, 'w') as f:
+	json.dump({'auth_key':password, 'key_backend':'recording', 'key_duration':0, 'profiles_db':'profiles.json', 'hold_timeout':0}, f)
+sys.argv = [os.path.join(here, '..', 'server.py'), settings_file]
+import server
+server.setup()
+
+username = 'benchmark'
+auth = {'Authorization':'Basic ' + base64.b64encode(username + ':' + password)}
+client = server.app.test_client()
+results = []
+
+# times fn n times and records throughput with latency percentiles in milliseconds.
+def measure(name, fn, n, **info):
+	samples = []
+	for i in xrange(n):
+		t = time.time()
+		fn()
+		samples.append(time.time() - t)
+	return record(name, samples, sum(samples), **info)
+
+def record(name, samples, wall, **info):
+	samples = sorted(samples)
+	n = len(samples)
+	r = {
+		'benchmark':name,
+		'count':n,
+		'ops_per_sec':n / wall if wall else 0.0,
+		'mean_ms':1000 * sum(samples) / n,
+		'p50_ms':1000 * samples[n // 2],
+		'p90_ms':1000 * samples[min(n - 1, int(n * 0.90))],
+		'p99_ms':1000 * samples[min(n - 1, int(n * 0.99))],
+		'max_ms':1000 * samples[-1]
+	}
+	r.update(info)
+	results.append(r)
+	print '{benchmark:<32} {count:>6} {ops_per_sec:>12.1f}/s  p50 {p50_ms:>8.3f} ms  p99 {p99_ms:>8.3f} ms'.format(**r)
+	return r
+
+# random macro of plain keys and combo groups drawn from the server's key codes.
+def random_macro(tokens):
+	keys = sorted(server.key_codes)
+	m = []
+	while len(m) < tokens:
+		if random.random() < 0.2:
+			m += [server.key_combo_seps['open'], random.choice(keys), random.choice(keys), server.key_combo_seps['close']]
+		else:
+			m.append(random.choice(keys))
+	return ' '.join(m)
+
+def random_profile(macros, tokens):
+	return {'macro {0}'.format(i):random_macro(tokens) for i in xrange(macros)}
+
+random.seed(0)
+
+# validation and compilation of one large profile
+large = random_profile(2000, 12)
+measure('validate_profile 2000 macros', lambda: server.validate_profile('large', large), 20)
+measure('compile_profile 2000 macros', lambda: server.compile_profile(large), 20)
+
+# per keystroke cost of resolving key names, through the key_codes dicts as before the key codes were
+# interned and through the interned table, and of compiling a long macro of single keys
+names = [random.choice(sorted(server.key_codes)) for i in xrange(10000)]
+def resolve_dict():
+	for k in names:
+		flags = server.KEYEVENTF.SCANCODE
+		if server.key_codes[k]['e0'] == 1:
+			flags |= server.KEYEVENTF.EXTENDEDKEY
+		server.key_codes[k]['sc'], flags | server.KEYEVENTF.KEYDOWN, flags | server.KEYEVENTF.KEYUP
+def resolve_table():
+	for k in names:
+		i = server.key_index[k]
+		server.key_scancodes[i], server.key_down[i], server.key_up[i]
+long_macro = ' '.join(names)
+for name, fn in [('keystroke lookup key_codes dict', resolve_dict), ('keystroke lookup interned table', resolve_table), ('keystroke compile_macro', lambda: server.compile_macro(long_macro))]:
+	r = measure(name, fn, 20, keys=len(names))
+	r['us_per_key'] = 1000 * r['mean_ms'] / len(names)
+
+# snapshot write and read with thousands of macros across many profiles
+db = {'profile {0}'.format(i):random_profile(250, 12) for i in xrange(20)}
+db_file = os.path.join(work_dir, 'db', 'profiles.json')
+measure('write_profiles 5000 macros', lambda: server.write_profiles(db, db_file, server.json_args), 10)
+measure('read_profiles 5000 macros', lambda: server.read_profiles(db_file), 10)
+
+# profile changes through the journal
+test_profile = {'benchmark':{'a':'a', 'combo':'[ lctrl lshift a ]', 'sentence':random_macro(40)}}
+r = client.post('/profiles/_bulk?replace=true', data=json.dumps(db), content_type='application/json', headers=auth)
+assert r.status_code == 200
+r = client.post('/profiles', data=json.dumps(test_profile), content_type='application/json', headers=auth)
+assert r.status_code == 201
+measure('PUT /profiles/<name>', lambda: client.put('/profiles/benchmark', data=json.dumps(test_profile), content_type='application/json', headers=auth), 200)
+
+# profile listing, full and conditional
+measure('GET /profiles', lambda: client.get('/profiles'), 500, profiles=len(server.profiles))
+etag = client.get('/profiles').headers['ETag']
+measure('GET /profiles If-None-Match', lambda: client.get('/profiles', headers={'If-None-Match':etag}), 500)
+measure('GET /', lambda: client.get('/'), 500)
+
+# macro dispatch through the scheduler, waiting for the macro and returning at once
+measure('GET macro single key', lambda: client.get('/profiles/benchmark/a', headers=auth), 1000)
+measure('GET macro 40 tokens', lambda: client.get('/profiles/benchmark/sentence', headers=auth), 200)
+measure('GET macro async', lambda: client.get('/profiles/benchmark/a?async=true', headers=auth), 1000)
+server.scheduler.drain()
+
+# concurrent execution from many panel clients at once
+def panel(samples, n):
+	c = server.app.test_client()
+	for i in xrange(n):
+		t = time.time()
+		c.get('/profiles/benchmark/combo', headers=auth)
+		samples.append(time.time() - t)
+
+samples = []
+threads = [threading.Thread(target=panel, args=(samples, 100)) for i in xrange(16)]
+t = time.time()
+for p in threads:
+	p.start()
+for p in threads:
+	p.join()
+record('GET macro 16 concurrent clients', samples, time.time() - t, scheduler=server.scheduler.report())
+
+# same requests over a real socket on the production server and the macro channel
+http_server = server.PooledWSGIServer('127.0.0.1', 0, server.app, 16, 64, 15)
+threading.Thread(target=http_server.serve_forever).start()
+conn = httplib.HTTPConnection('127.0.0.1', http_server.server_address[1])
+def socket_get(path, headers={}):
+	conn.request('GET', path, headers=headers)
+	conn.getresponse().read()
+measure('socket GET /', lambda: socket_get('/'), 500)
+measure('socket GET macro single key', lambda: socket_get('/profiles/benchmark/a', auth), 500)
+http_server.shutdown()
+
+channel = server.start_channel('127.0.0.1', 0)
+c = socket.create_connection(channel[0].server_address)
+c.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+f = c.makefile('rb')
+c.sendall('AUTH {0} {1}\n'.format(username, password))
+assert f.readline().startswith('OK')
+def channel_press():
+	c.sendall('X benchmark a\n')
+	f.readline()
+measure('channel macro single key', channel_press, 1000)
+c.close()
+for s in channel:
+	s.shutdown()
+server.scheduler.drain()
+
+with open(output_file, 'w') as f:
+	json.dump({'app_version':server.app_version, 'api_version':server.api_version, 'time':time.strftime('%Y-%m-%dT%H:%M:%S'), 'results':results}, f, indent=4, sort_keys=True)
+print 'Results written to {0}'.format(output_file)
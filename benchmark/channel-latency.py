@@ -0,0 +1,76 @@
+# pyRESTvk/benchmark/channel-latency.py
+# Dan Allongo (daniel.s.allongo@gmail.com)
+
+# Compares per-press latency of the HTTP macro endpoint against the persistent TCP
+# macro channel. Run the server with 'key_backend' set to 'null' so only dispatch is
+# measured, and 'channel_port' set to the port below.
+
+import requests
+import platform
+import socket
+import time
+import json
+
+# default host and ports
+server_ip = '127.0.0.1'
+server_port = 5000
+channel_port = 5001
+# pass hostname as username
+username = platform.node()
+# http password
+password = ''
+# number of presses per transport
+presses = 500
+profile = {'channel-latency':{'a':'a'}}
+
+base_url = 'http://' + server_ip + ':' + str(server_port)
+
+# summary of latencies in milliseconds.
+def summarize(name, samples):
+	samples = sorted(samples)
+	n = len(samples)
+	return {
+		'transport':name,
+		'presses':n,
+		'mean_ms':1000 * sum(samples) / n,
+		'p50_ms':1000 * samples[n // 2],
+		'p99_ms':1000 * samples[min(n - 1, int(n * 0.99))],
+		'max_ms':1000 * samples[-1],
+		'presses_per_sec':n / sum(samples)
+	}
+
+s = requests.Session()
+s.auth = (username, password)
+# upload benchmark profile, replacing any copy left by an earlier run
+r = s.post(base_url + '/profiles/_bulk', json=profile, params={'replace':'true'})
+assert r.status_code == 200
+macro_url = r.json()['profiles'][profile.keys()[0]]['url'] + '/a'
+
+# one GET per press on a keep-alive session
+http = []
+for i in xrange(presses):
+	t = time.time()
+	r = s.get(macro_url, params={'async':'true'})
+	http.append(time.time() - t)
+	assert r.status_code == 202
+
+# one frame per press on a single authenticated connection
+c = socket.create_connection((server_ip, channel_port))
+c.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+f = c.makefile('rb')
+c.sendall('AUTH {0} {1}\n'.format(username, password))
+assert f.readline().startswith('OK')
+frame = 'X channel-latency a\n'
+channel = []
+for i in xrange(presses):
+	t = time.time()
+	c.sendall(frame)
+	reply = f.readline()
+	channel.append(time.time() - t)
+	assert reply.startswith('OK')
+c.close()
+
+print json.dumps([summarize('http', http), summarize('tcp-channel', channel)], indent=4, sort_keys=True)
+
+r = s.delete(base_url + '/profiles/' + profile.keys()[0])
+assert r.status_code == 204
@@ -0,0 +1,79 @@
+# pyRESTvk/benchmark/serving.py
+# Dan Allongo (daniel.s.allongo@gmail.com)
+
+# Measures throughput and latency percentiles of the HTTP service under concurrent
+# keep-alive clients. Run once with 'server_mode' set to 'development' and once with
+# 'production' to compare, with 'key_backend' set to 'null' so only serving is measured.
+
+import requests
+import platform
+import threading
+import time
+import json
+
+# default host and port
+server_ip = '127.0.0.1'
+server_port = 5000
+# pass hostname as username
+username = platform.node()
+# http password
+password = ''
+# concurrent panel clients and requests sent by each
+clients = 16
+requests_per_client = 200
+profile = {'serving':{'a':'a'}}
+
+base_url = 'http://' + server_ip + ':' + str(server_port)
+
+# summary of latencies in milliseconds and requests per second over wall time.
+def summarize(name, samples, failures, wall):
+	samples = sorted(samples)
+	n = len(samples)
+	return {
+		'endpoint':name,
+		'requests':n,
+		'errors':len(failures),
+		'requests_per_sec':n / wall,
+		'mean_ms':1000 * sum(samples) / n,
+		'p50_ms':1000 * samples[n // 2],
+		'p99_ms':1000 * samples[min(n - 1, int(n * 0.99))],
+		'max_ms':1000 * samples[-1]
+	}
+
+# one panel client with its own keep-alive session.
+def client(url, params, samples, failures):
+	s = requests.Session()
+	s.auth = (username, password)
+	for i in xrange(requests_per_client):
+		t = time.time()
+		r = s.get(url, params=params)
+		samples.append(time.time() - t)
+		if r.status_code not in [200, 202]:
+			failures.append(r.status_code)
+
+# runs all clients against url at once.
+def run(name, url, params={}):
+	samples = []
+	failures = []
+	threads = [threading.Thread(target=client, args=(url, params, samples, failures)) for i in xrange(clients)]
+	t = time.time()
+	for c in threads:
+		c.start()
+	for c in threads:
+		c.join()
+	return summarize(name, samples, failures, time.time() - t)
+
+s = requests.Session()
+s.auth = (username, password)
+r = s.get(base_url)
+assert r.status_code == 200
+# upload benchmark profile, replacing any copy left by an earlier run
+r = s.post(base_url + '/profiles/_bulk', json=profile, params={'replace':'true'})
+assert r.status_code == 200
+macro_url = r.json()['profiles'][profile.keys()[0]]['url'] + '/a'
+
+results = [run('status', base_url), run('macro', macro_url, {'async':'true'})]
+print json.dumps(results, indent=4, sort_keys=True)
+
+r = s.delete(base_url + '/profiles/' + profile.keys()[0])
+assert r.status_code == 204
@@ -0,0 +1,351 @@
+# pyRESTvk/client.py
+# Dan Allongo (daniel.s.allongo@gmail.com)
+
+# Client library for the pyRESTvk service, mirroring its API. Keeps one pooled keep-alive session,
+# reads resource URLs from the status document once, and sends If-None-Match for resources it has
+# read before so unchanged ones are not sent again. Profiles are checked locally before they are
+# uploaded, and button presses can be sent from a bounded queue on background threads so the caller
+# never waits on a macro. AsyncClient is the asyncio variant, fan_out runs one call on many servers.
+# Runs on python 2.7 like the server, asyncio needs python 3.
+
+import requests
+import threading
+import functools
+import re
+import logging
+try:
+	import Queue as queue
+except ImportError:
+	import queue
+try:
+	from urllib import quote as url_quote, unquote
+except ImportError:
+	from urllib.parse import quote as url_quote, unquote
+try:
+	import asyncio
+	import concurrent.futures
+except ImportError:
+	asyncio = None
+try:
+	string_types = basestring
+except NameError:
+	string_types = str
+
+logger = logging.getLogger('pyRESTvk.client')
+
+# raised for responses other than those expected, with the message sent by the server.
+class ClientError(Exception):
+	def __init__(self, message, status_code=None):
+		Exception.__init__(self, message)
+		self.status_code = status_code
+
+# raises ClientError unless response has one of the expected status codes.
+def check(r, *codes):
+	if r.status_code in codes:
+		return r
+	try:
+		message = r.json()['message']
+	except (ValueError, KeyError, TypeError):
+		message = r.reason
+	raise ClientError("{0} {1}: {2}".format(r.request.method, r.url, message), r.status_code)
+
+def quote(name):
+	if not isinstance(name, str):
+		name = name.encode('utf-8')
+	return url_quote(name, safe='')
+
+# same token forms as the server, 'a@40,10*5', '~250' and '&name'.
+macro_token_re = re.compile(r'^(.+?)(?:@(\d+(?:\.\d*)?)(?:,(\d+(?:\.\d*)?))?)?(?:\*(\d+))?$')
+wait_token_re = re.compile(r'^~\d+(?:\.\d*)?$')
+
+# checks macros of profile against key codes of the server, returns error messages. catches what a panel
+# author gets wrong (unknown keys, unbalanced combos, missing references), the server still validates fully.
+def profile_errors(name, macros, key_codes, combo_seps={'open':'[', 'close':']'}):
+	errors = []
+	if not isinstance(macros, dict) or not macros:
+		return ["Invalid Profile: No Macros for Profile '{0}'".format(name)]
+	for n, m in macros.items():
+		if isinstance(m, dict):
+			m = m.get('keys')
+		if not isinstance(m, string_types) or not m.strip():
+			errors.append("Invalid Macro: Macro '{0}' for Profile '{1}' Must Be a Non-Empty String".format(n, name))
+			continue
+		open_combo = False
+		for token in m.split():
+			key = macro_token_re.match(token).group(1)
+			if key == combo_seps['open']:
+				if open_combo:
+					errors.append("Invalid Combo: Nested '{0}' in Macro '{1}' for Profile '{2}'".format(key, n, name))
+				open_combo = True
+			elif key == combo_seps['close']:
+				if not open_combo:
+					errors.append("Invalid Combo: '{0}' Before '{1}' in Macro '{2}' for Profile '{3}'".format(key, combo_seps['open'], n, name))
+				open_combo = False
+			elif key.startswith('~'):
+				if not wait_token_re.match(key):
+					errors.append("Invalid Wait: '{0}' in Macro '{1}' for Profile '{2}'".format(token, n, name))
+			elif key.startswith('&'):
+				if unquote(key[1:]) not in macros:
+					errors.append("Invalid Reference: Macro '{0}' Not Found for Macro '{1}' in Profile '{2}'".format(unquote(key[1:]), n, name))
+			elif key not in key_codes:
+				errors.append("Invalid Key Code: '{0}' in Macro '{1}' for Profile '{2}'".format(key, n, name))
+		if open_combo:
+			errors.append("Invalid Combo: '{0}' Without '{1}' in Macro '{2}' for Profile '{3}'".format(combo_seps['open'], combo_seps['close'], n, name))
+	return errors
+
+# one server. the status document is read once for resource URLs and reused until refresh is requested.
+# bodies of GET requests are kept with their ETag and sent again by the server only when they changed.
+class Client(object):
+	def __init__(self, server_url, username, password, timeout=5, retries=3, pool_size=4):
+		self.server_url = server_url.rstrip('/')
+		self.timeout = timeout
+		self.session = requests.Session()
+		# every request goes to the same host, keep up to pool_size connections to it alive
+		adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retries)
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
+		self.username = username
+		self.password = password
+		self.session.auth = (username, password)
+		self.etags = {}
+		self._status = None
+
+	# sends request with the session token once auth() was called, getting a new token if it expired.
+	def request(self, method, url, **kwargs):
+		kwargs.setdefault('timeout', self.timeout)
+		r = self.session.request(method, url, **kwargs)
+		if r.status_code == 401 and self.session.auth[1] != self.password:
+			self.auth()
+			r = self.session.request(method, url, **kwargs)
+		return r
+
+	# GET of JSON resource, conditional on the ETag of the copy read before.
+	def get(self, url, params=None, refresh=False):
+		key = (url, tuple(sorted((params or {}).items())))
+		cached = None if refresh else self.etags.get(key)
+		r = self.request('GET', url, params=params, headers={'If-None-Match':cached[0]} if cached else {})
+		if r.status_code == 304 and cached:
+			return cached[1]
+		body = check(r, 200).json()
+		if 'etag' in r.headers:
+			self.etags[key] = (r.headers['etag'], body)
+		return body
+
+	# drops copies of resource at url read before, after it was changed by this client.
+	def forget(self, url):
+		for key in [key for key in self.etags if key[0] == url]:
+			del self.etags[key]
+		return
+
+	# status document, only read again with refresh since it is used for resource URLs.
+	def status(self, refresh=False):
+		if self._status is None or refresh:
+			self._status = self.get(self.server_url, refresh=refresh)
+		return self._status
+
+	def url(self, resource):
+		return self.status()[resource]['url']
+
+	def profile_url(self, name):
+		return self.url('profiles') + '/' + quote(name)
+
+	def macro_url(self, profile, macro):
+		return self.profile_url(profile) + '/' + quote(macro)
+
+	def job_url(self, job_id):
+		return self.url('jobs') + '/' + str(job_id)
+
+	# registers client with the server and sends the session token it issues in place of the password from
+	# then on, which the server checks faster.
+	def auth(self):
+		r = check(self.session.request('GET', self.server_url + '/auth', auth=(self.username, self.password), timeout=self.timeout), 200).json()
+		if 'token' in r:
+			self.session.auth = (self.username, r['token'])
+		return r
+
+	def clients(self):
+		return self.get(self.url('clients'))
+
+	def key_codes(self):
+		return self.get(self.url('key_codes'))
+
+	def metrics(self):
+		return check(self.request('GET', self.url('metrics')), 200).text
+
+	def profiles(self):
+		return self.get(self.url('profiles'))
+
+	def profile(self, name):
+		return self.get(self.profile_url(name))
+
+	# checks profiles on the server without storing them, returns error dicts with where each was found.
+	def validate_profiles(self, profiles):
+		r = check(self.request('POST', self.url('profiles'), json=profiles, params={'validate_only':'true'}), 200, 400)
+		return r.json().get('errors', [])
+
+	# creates profile given as {name:macros}, returns its URL.
+	def create_profile(self, profile):
+		url = check(self.request('POST', self.url('profiles'), json=profile), 201).headers['location']
+		self.forget(url)
+		return url
+
+	# replaces profile, renaming it if profile has another name. the server refuses the change with 412 if
+	# the profile was changed since it was last read with profile().
+	def update_profile(self, name, profile):
+		url = self.profile_url(name)
+		cached = self.etags.get((url, ()))
+		r = check(self.request('PUT', url, json=profile, headers={'If-Match':cached[0]} if cached else {}), 201, 204)
+		# the copies read before no longer match, the next update must not send their ETag
+		self.forget(url)
+		self.forget(r.headers.get('location', url))
+		return r.headers.get('location', url)
+
+	def delete_profile(self, name):
+		url = self.profile_url(name)
+		check(self.request('DELETE', url), 204)
+		self.forget(url)
+		return
+
+	# imports many profiles at once, all or nothing.
+	def import_profiles(self, profiles, replace=False):
+		return check(self.request('POST', self.url('profiles') + '/_bulk', json=profiles, params={'replace':str(replace).lower()}), 200).json()['profiles']
+
+	def export_profiles(self):
+		return check(self.request('GET', self.url('profiles') + '/_bulk'), 200).json()
+
+	# uploads profile given as {name:macros} unless the server copy is the same, returns its URL. the profile
+	# is checked locally first so a broken profile costs no round trip.
+	def sync_profile(self, profile):
+		name, macros = next(iter(profile.items()))
+		errors = profile_errors(name, macros, self.key_codes())
+		if errors:
+			raise ClientError(errors[0])
+		try:
+			current = self.profile(name)
+		except ClientError as e:
+			if e.status_code != 404:
+				raise
+			return self.create_profile(profile)
+		if current != profile:
+			# only overwrite the copy that was compared
+			return self.update_profile(name, profile)
+		return self.profile_url(name)
+
+	# runs macro and returns once it has run, or at once with the job URL when wait is False.
+	def run(self, profile, macro, wait=True):
+		return check(self.request('GET', self.macro_url(profile, macro), params={'async':str(not wait).lower()}), 200, 202).json()
+
+	# presses and holds macro of a single key or combo until release() or another run() of it.
+	def hold(self, profile, macro):
+		return check(self.request('GET', self.macro_url(profile, macro), params={'hold':'true'}), 200, 202).json()
+
+	# releases held macro, does nothing if it is not held.
+	def release(self, profile, macro):
+		return check(self.request('GET', self.macro_url(profile, macro), params={'release':'true'}), 200, 202).json()
+
+	# runs list of macro names or item objects back to back, see /profiles/<name>/_batch.
+	def batch(self, profile, items, wait=True):
+		r = check(self.request('POST', self.profile_url(profile) + '/_batch', json={'macros':items}, params={'async':str(not wait).lower()}), 200, 202)
+		return r.json()['results']
+
+	def held(self):
+		return check(self.request('GET', self.server_url + '/held'), 200).json()
+
+	# releases all held keys, or only those held by one client.
+	def release_all(self, client=None):
+		check(self.request('DELETE', self.server_url + '/held', params={'client':client} if client else {}), 204)
+		return
+
+	def jobs(self):
+		return check(self.request('GET', self.url('jobs')), 200).json()
+
+	def job(self, job_id):
+		return check(self.request('GET', self.job_url(job_id)), 200).json()
+
+	def cancel_job(self, job_id):
+		return check(self.request('DELETE', self.job_url(job_id)), 200, 409).json()
+
+	def shutdown(self):
+		return check(self.request('GET', self.server_url + '/shutdown'), 200).json()
+
+# asyncio variant of Client. every method returns an awaitable future of the Client method run on a pool of
+# workers threads, each request with its own pooled connection. raises RuntimeError without asyncio.
+class AsyncClient(object):
+	def __init__(self, server_url, username, password, workers=4, **kwargs):
+		if asyncio is None:
+			raise RuntimeError('AsyncClient Requires asyncio')
+		self.client = Client(server_url, username, password, pool_size=workers, **kwargs)
+		self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+
+	def __getattr__(self, name):
+		attr = getattr(self.client, name)
+		if not callable(attr):
+			return attr
+		def call(*args, **kwargs):
+			return asyncio.get_event_loop().run_in_executor(self.executor, functools.partial(attr, *args, **kwargs))
+		return call
+
+	def close(self):
+		self.executor.shutdown()
+		return
+
+# calls the same method on many clients at once, ie fan_out(clients, 'run', 'sim', 'gear up') to press a
+# button on every sim PC. returns the result of each client in order, or the exception it raised. with
+# AsyncClient, asyncio.gather(*[c.run('sim', 'gear up') for c in clients]) does the same.
+def fan_out(clients, method, *args, **kwargs):
+	results = [None] * len(clients)
+	def call(i, c):
+		try:
+			results[i] = getattr(c, method)(*args, **kwargs)
+		except Exception as e:
+			results[i] = e
+	threads = [threading.Thread(target=call, args=(i, c)) for i, c in enumerate(clients)]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	return results
+
+# sends macro requests from a bounded queue on background threads, in the order they were queued with a
+# single worker. a press is dropped with a warning when the queue is full so the caller never blocks.
+# callback is called from the worker thread with each response.
+class MacroSender(object):
+	def __init__(self, client, workers=1, maxsize=16, callback=None):
+		self.client = client
+		self.callback = callback
+		self.queue = queue.Queue(maxsize)
+		self.workers = []
+		for i in range(workers):
+			t = threading.Thread(target=self.run, name='macro-sender-{0}'.format(i))
+			t.daemon = True
+			t.start()
+			self.workers.append(t)
+
+	def press(self, url, params=None):
+		try:
+			self.queue.put_nowait((url, params))
+		except queue.Full:
+			logger.warning("Queue Full: Dropped Request for '{0}'".format(url))
+			return False
+		return True
+
+	def run(self):
+		while True:
+			url, params = self.queue.get()
+			if url is None:
+				return
+			try:
+				r = self.client.request('GET', url, params=params)
+			except requests.RequestException as e:
+				logger.error("Request Failed: '{0}': {1}".format(url, e))
+				continue
+			if self.callback:
+				self.callback(r)
+
+	# stops workers once the presses already queued have been sent.
+	def stop(self):
+		for t in self.workers:
+			self.queue.put((None, None))
+		for t in self.workers:
+			t.join()
+		return
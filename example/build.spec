@@ -3,7 +3,7 @@ import os
 install_hooks(globals())
 # -*- mode: python -*-
 a = Analysis(['\\pyRESTvk\\example\\main.py'],
-             pathex=['\\build'],
+             pathex=['\\build', '\\pyRESTvk'],
              hiddenimports=[],
              runtime_hooks=None)
 pyz = PYZ(a.pure)
@@ -6,8 +6,9 @@
 
 from kivy.uix.floatlayout import FloatLayout
 from kivy.app import App
-from requests import Session, adapters
 from distutils.version import LooseVersion
+from functools import partial
+import requests
 import json
 import platform
 import os
@@ -15,6 +16,10 @@ import sys
 from kivy.logger import Logger
 import logging, logging.handlers
 
+# client library is kept next to server.py
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(sys.argv[0]), '..')))
+from client import Client, ClientError, MacroSender
+
 api_version = '2.1'
 
 class SwitchPanel(FloatLayout):
@@ -23,12 +28,28 @@ class SwitchPanel(FloatLayout):
         FloatLayout.__init__(self)
         # load the kivy button mappings for the macros
         with open(mappings) as f:
-        	self.mappings = json.load(f)
+            self.mappings = json.load(f)
         # load the macro profile for this application
         with open(profile) as f:
-	        p = json.load(f)
+            p = json.load(f)
         k = p.keys()[0]
-        # apply button labels, colors, and macros
+        # pass hostname as username and auth key as password, requests share pooled keep-alive connections
+        # and retry up to 3x
+        self.client = Client(server_url, platform.node(), auth_key)
+        try:
+            # authenticate and register client
+            self.client.auth()
+            # confirm server api version, status is kept for resource URLs
+            if LooseVersion(self.client.status()['application']['api']) < LooseVersion(api_version):
+                Logger.error('init: Incompatible Server: API version >= {0} Required'.format(api_version))
+                exit(1)
+            # validate profile against server key codes, then create or update it if the server copy differs
+            self.client.sync_profile(p)
+        except (ClientError, requests.RequestException) as e:
+            Logger.error('init: {0}'.format(e))
+            sys.exit(1)
+        # apply button labels, colors, and macros. button ids map straight to macro URL and parameters
+        self.presses = {}
         for i, b in self.mappings.iteritems():
             if i in self.ids:
                 if 'label' in b:
@@ -36,72 +57,30 @@ class SwitchPanel(FloatLayout):
                 if 'color' in b and b['color'] in colors:
                     self.ids[i].color = colors[b['color']]
                 if 'macro' in b and b['macro'] in p[k]:
-                    self.ids[i].bind(on_press=self.make_request)
+                    self.presses[i] = (self.client.macro_url(k, b['macro']), b.get('params', {}))
+                    self.ids[i].bind(on_press=partial(self.make_request, i))
                 if 'background_down' in dir(self.ids[i]):
                     if 'background_down' in b:
                         self.ids[i].background_down = b['background_down']
-                    else:    
+                    else:
                         self.ids[i].background_down = 'atlas://data/images/defaulttheme/button_disabled'
-        # pass hostname as username
-        username = platform.node()
-        # set password to auth key
-    	password = auth_key
-        # session will send auth for requests, retry up to 3x
-        self.s = Session()
-        self.s.mount("http://", adapters.HTTPAdapter(max_retries=3))
-        self.s.auth=(username, password)
-        self.server_url = server_url
-        # authenticate and register client
-        r = self.s.get(self.server_url + '/auth', timeout=5)
-        if r.status_code != 200:
-            Logger.error('init: Unable to Authenticate: Expected Response Code 200, Got {0}'.format(r.status_code))
-            exit(1)
-        # confirm server api version
-        r = self.s.get(self.server_url, timeout=5)
-        if LooseVersion(r.json()['application']['api']) < LooseVersion(api_version):
-            Logger.error('init: Incompatible Server: API version >= {0} Required'.format(api_version))
-            exit(1)
-        # get resource URLs
-        r = self.s.get(self.server_url, timeout=5)
-        profiles_url = r.json()['profiles']['url']
-        # validate profile
-        r = self.s.post(profiles_url, files={k:open(profile, 'rb')}, params={'validate_only':'true'}, timeout=5)
-        if r.status_code != 200:
-            Logger.error(r.json()['message'])
-            sys.exit(1)
-        r = self.s.get(profiles_url, timeout=5)
-        # find and update profile if it exists
-        profiles = r.json()
-        profile_url = ''
-        if k in profiles:
-            profile_url = profiles[k]['url']
-            r = self.s.get(profile_url, timeout=5)
-            if r.json() != p:
-                r = self.s.put(profile_url, files={k:open(profile, 'rb')}, timeout=5)
-                if r.status_code != 204:
-                    Logger.error('init: Unable to Update Profile: Expected Response Code 204, Got {0}'.format(r.status_code))
-                    exit(1)
-        else:
-            r = self.s.post(profiles_url, files={k:open(profile, 'rb')}, timeout=5)
-            if r.status_code != 201:
-                Logger.error('init: Unable to Create Profile: Expected Response Code 201, Got {0}'.format(r.status_code))
-                exit(1)
-            profile_url = r.headers['location']
-        self.profile_url = profile_url
+        # macros are sent in order off the UI thread so the panel stays responsive during slow macros
+        self.sender = MacroSender(self.client, callback=self.log_response)
         return
 
     def shutdown(self):
-        # call server shutdown
-        self.s.get(self.server_url + '/shutdown', timeout=5)
+        # call server shutdown once queued presses are sent
+        self.sender.stop()
+        self.client.request('GET', self.client.server_url + '/shutdown')
+        return
+
+    def make_request(self, i, btn):
+        url, params = self.presses[i]
+        self.sender.press(url, params)
         return
 
-    def make_request(self, btn):
-        for i, w in self.ids.iteritems():
-            if w == btn and i in self.mappings:
-            	p = self.mappings[i].get('params', {})
-                # run macro
-                r = self.s.get(self.profile_url + '/' + self.mappings[i]['macro'], params=p, timeout=5)
-                Logger.info('make_request: {0} - {1} (in {2} sec)'.format(r.url, r.status_code, r.elapsed.total_seconds()))
+    def log_response(self, r):
+        Logger.info('make_request: {0} - {1} (in {2} sec)'.format(r.url, r.status_code, r.elapsed.total_seconds()))
         return
 
 
@@ -5,98 +5,671 @@
 # Using basic HTTP authentication with no WWW authentication challenge as browsers
 # are not the target client. Valid key codes are loaded from external file.
 
-from flask import Flask, url_for, redirect, abort, request, jsonify, make_response, send_file
-from werkzeug.exceptions import default_exceptions, HTTPException
+from flask import Flask, url_for, redirect, abort, request, jsonify, make_response, send_file, Response
+from flask import json as flask_json
+from werkzeug.exceptions import default_exceptions, HTTPException, ClientDisconnected
+from werkzeug.wsgi import LimitedStream
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
 import os
 import random
 import datetime
 import socket
 import json
-import win32api
+# pywin32 is only needed by the keybd_event backend, allow the server to start without it elsewhere.
+try:
+	import win32api
+except ImportError:
+	win32api = None
+import ctypes
 import time
 import sys
+import threading
+import itertools
+import heapq
+import atexit
+import hashlib
+import hmac
+import SocketServer
+import urllib
+import Queue
+import select
+import bisect
+import re
+import mmap
 from distutils.dir_util import mkpath
 from distutils.version import LooseVersion
 import StringIO
-from collections import namedtuple
+from collections import namedtuple, deque, OrderedDict, MutableMapping
+from array import array
 import logging, logging.handlers
 import locale
 
 # server changes that affect endpoint functionality or break test script should increment api version.
-app_version = '0.8.0-beta'
-api_version = '2.1'
+app_version = '0.9.0-beta'
+api_version = '2.2'
 
 # generates new auth key if needed.
 def generate_auth_key():
 	return '-'.join([str(int(random.random()*1000)) for i in xrange(4)])
 
-# validates profile schema.
-def validate_profile(k, p):
-	global key_codes, key_combo_seps
-	http_reserved = "!*'();:@&=+$,/?#[]"
-	for c in http_reserved:
-		if c in k:
-			return False, "Invalid Character: '{0}' in Profile 'name' {1}'".format(c, k)
-	if not p.keys():
-		return False, "Profile Empty: No Macros for Profile '{0}'".format(k)
+# profile and macro names cannot include HTTP reserved characters.
+http_reserved = re.compile(r"[!*'();:@&=+$,/?#\[\]]")
+# names taken by resources under /profiles and /profiles/<name>, a profile or macro with one could not be reached.
+reserved_profiles = frozenset(['_bulk'])
+reserved_macros = frozenset(['_batch'])
+
+# fields of a macro given as object instead of string.
+macro_fields = frozenset(['keys', 'key_duration', 'key_gap'])
+
+# extended macro tokens, written without spaces:
+#   a@40 a@40,10  - per token timing in milliseconds, holds a for 40 ms and also waits 10 ms before the next
+#                   step. on the combo close separator it applies to the whole combo, ie '[ lctrl a ]@40'
+#   a*5 ]*5       - repeats key or combo 5 times, after any timing, ie 'a@40*5'
+#   ~250          - waits 250 ms
+#   &name &name*2 - runs another macro of the same profile in place, name is URL-quoted (ie, '&type%20notepad')
+# everything is expanded when the macro is compiled, so execution does not depend on how it was written.
+macro_token_re = re.compile(r'^(.+?)(?:@(\d+(?:\.\d*)?)(?:,(\d+(?:\.\d*)?))?)?(?:\*(\d+))?$')
+wait_token_re = re.compile(r'^~\d+(?:\.\d*)?$')
+max_repeat = 1000
+max_macro_steps = 10000
+
+# validates profile schema in a single pass over every macro, returns all errors found as dicts with the
+# message and where it was found. position is the character index in a name or token index in a macro.
+# valid_tokens is the frozen set of key names and combo separators built when key codes are loaded.
+# macro references are checked for cycles and expanded size once every macro has been read.
+def profile_errors(k, p):
+	global valid_tokens, key_combo_seps
+	errors = []
+	def error(message, macro=None, position=None):
+		errors.append({'profile':k, 'macro':macro, 'position':position, 'message':message})
+	c = http_reserved.search(k)
+	if c:
+		error("Invalid Character: '{0}' in Profile 'name' '{1}'".format(c.group(), k), None, c.start())
+	if k in reserved_profiles:
+		error("Reserved Name: Profile 'name' '{0}' is Used by the API".format(k), None, 0)
+	if not isinstance(p, dict):
+		error("Invalid Profile: Macros for Profile '{0}' Must Be an Object".format(k))
+		return errors
+	if not p:
+		error("Profile Empty: No Macros for Profile '{0}'".format(k))
+	combo_open, combo_close = key_combo_seps['open'], key_combo_seps['close']
+	# steps of each macro not counting references, and references as (macro, repeat, position)
+	steps = {}
+	refs = {}
 	for n, m in p.iteritems():
-		for c in http_reserved:
-			if c in n:
-				return False, "Invalid Character: '{0}' in Macro 'name' '{1}' for Profile '{2}'".format(c, n, k)
+		c = http_reserved.search(n)
+		if c:
+			error("Invalid Character: '{0}' in Macro 'name' '{1}' for Profile '{2}'".format(c.group(), n, k), n, c.start())
+		if n in reserved_macros:
+			error("Reserved Name: Macro 'name' '{0}' for Profile '{1}' is Used by the API".format(n, k), n, 0)
+		# macro can also be an object with its own key duration and gap in seconds
+		if isinstance(m, dict):
+			for f, v in m.iteritems():
+				if f not in macro_fields:
+					error("Invalid Macro: Unknown Field '{0}' in Macro '{1}' for Profile '{2}'".format(f, n, k), n)
+				elif f != 'keys' and (isinstance(v, bool) or not isinstance(v, (int, long, float)) or v < 0):
+					error("Invalid Macro: '{0}' in Macro '{1}' for Profile '{2}' Must Be a Number of Seconds".format(f, n, k), n)
+			m = m.get('keys')
+		if not isinstance(m, basestring):
+			error("Invalid Macro: Macro '{0}' for Profile '{1}' Must Be a String".format(n, k), n)
+			continue
 		if not m:
-			return False, "Macro Empty: No Keys in Macro '{0}' for Profile '{1}'".format(n, k)
-		combo = []
-		open_combo = False
-		for key in m.split():
-			if key not in key_codes and key not in [key_combo_seps['open'], key_combo_seps['close']]:
-				return False, "Invalid Key Code: '{0}' in Macro '{1}' for Profile '{2}'".format(key, n, k)
-			if key == key_combo_seps['open']:
-				if open_combo:
-					return False, "Invalid Combo: Nested '{0}' in Macro '{1}' for Profile '{2}'".format(key_combo_seps['open'], n, k)
-				open_combo = True
-				continue
-			if key == key_combo_seps['close']:
-				if not open_combo:
-					return False, "Invalid Combo: '{0}' Before '{1}' in Macro '{2}' for Profile '{3}'".format(key_combo_seps['close'], key_combo_seps['open'], n, k)
-				open_combo = False
-			if open_combo:
-				combo.append(key_codes[key])
-				continue
-			if combo:
-				combo = []
-		if open_combo or combo:
-			return False, "Invalid Combo: '{0}' Without '{1}' in Macro '{2}' for Profile '{3}'".format(key_combo_seps['open'], key_combo_seps['close'], n, k)
+			error("Macro Empty: No Keys in Macro '{0}' for Profile '{1}'".format(n, k), n)
+			continue
+		open_combo = None
+		steps[n] = 0
+		refs[n] = []
+		for i, key in enumerate(m.split()):
+			count = 1
+			if key not in valid_tokens:
+				t = macro_token_re.match(key)
+				key, count = t.group(1), int(t.group(4) or 1)
+				if t.group(4) and not 1 <= count <= max_repeat:
+					error("Invalid Repeat: '{0}' in Macro '{1}' for Profile '{2}' Must Be 1 to {3}".format(t.group(0), n, k, max_repeat), n, i)
+				if (t.group(2) or t.group(4)) and (key == combo_open or (open_combo is not None and key != combo_close)):
+					error("Invalid Timing: '{0}' Only Allowed on Key or '{1}' in Macro '{2}' for Profile '{3}'".format(t.group(0), combo_close, n, k), n, i)
+				if key[0] in '~&':
+					if open_combo is not None:
+						error("Invalid Combo: '{0}' Inside Combo in Macro '{1}' for Profile '{2}'".format(t.group(0), n, k), n, i)
+					elif key[0] == '~' and (t.group(2) or not wait_token_re.match(key)):
+						error("Invalid Wait: '{0}' in Macro '{1}' for Profile '{2}'".format(t.group(0), n, k), n, i)
+					elif key[0] == '~':
+						steps[n] += count
+					elif t.group(2):
+						error("Invalid Timing: '{0}' Only Allowed on Key or '{1}' in Macro '{2}' for Profile '{3}'".format(t.group(0), combo_close, n, k), n, i)
+					elif urllib.unquote(key[1:]) not in p:
+						error("Invalid Reference: Macro '{0}' Not Found for Macro '{1}' in Profile '{2}'".format(urllib.unquote(key[1:]), n, k), n, i)
+					else:
+						refs[n].append((urllib.unquote(key[1:]), count, i))
+					continue
+			if key not in valid_tokens:
+				error("Invalid Key Code: '{0}' in Macro '{1}' for Profile '{2}'".format(key, n, k), n, i)
+			elif key == combo_open:
+				if open_combo is not None:
+					error("Invalid Combo: Nested '{0}' in Macro '{1}' for Profile '{2}'".format(combo_open, n, k), n, i)
+				open_combo = i
+			elif key == combo_close:
+				if open_combo is None:
+					error("Invalid Combo: '{0}' Before '{1}' in Macro '{2}' for Profile '{3}'".format(combo_close, combo_open, n, k), n, i)
+				open_combo = None
+				steps[n] += count
+			elif open_combo is None:
+				steps[n] += count
+		if open_combo is not None:
+			error("Invalid Combo: '{0}' Without '{1}' in Macro '{2}' for Profile '{3}'".format(combo_open, combo_close, n, k), n, open_combo)
+	# depth first walk of references without recursion. a reference to a macro still being expanded is a cycle.
+	expanded = {}
+	for root in refs:
+		if root in expanded:
+			continue
+		expanded[root] = None
+		stack = [(root, iter(refs[root]))]
+		while stack:
+			n, it = stack[-1]
+			for r, count, i in it:
+				if r not in expanded:
+					expanded[r] = None
+					stack.append((r, iter(refs.get(r, []))))
+					break
+				if expanded[r] is None:
+					error("Invalid Reference: Macro '{0}' Refers Back to Macro '{1}' in Profile '{2}'".format(n, r, k), n, i)
+			else:
+				stack.pop()
+				expanded[n] = steps.get(n, 0) + sum((expanded[r] or 0) * count for r, count, i in refs.get(n, []))
+				if expanded[n] > max_macro_steps and n in steps:
+					error("Macro Too Long: Macro '{0}' for Profile '{1}' Expands to {2} Steps, Limit is {3}".format(n, k, expanded[n], max_macro_steps), n)
+	return errors
+
+# validates profile schema, returns whether it is valid with the first error message.
+def validate_profile(k, p):
+	errors = profile_errors(k, p)
+	if errors:
+		return False, errors[0]['message']
 	return True, "OK"
 
-# writes validated profiles to file.
+# replaces dst with src in one step so readers never see a partially written file. os.rename will not
+# overwrite an existing file on windows, MoveFileEx with MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH will.
+def replace_file(src, dst):
+	if sys.platform == 'win32':
+		if not ctypes.windll.kernel32.MoveFileExW(unicode(src), unicode(dst), 0x1 | 0x8):
+			raise ctypes.WinError()
+	else:
+		os.rename(src, dst)
+	return
+
+# writes profiles snapshot to file atomically. profiles are already validated when they are accepted.
 def write_profiles(profiles, profiles_db, json_args):
-	global logger_name
-	to_disk = {}
-	for k, p in profiles.iteritems():
-		validated, msg = validate_profile(k, p)
-		if not validated:
-			logging.getLogger(logger_name).warning("Discarding Profile: {0}".format(msg))
-			continue
-		to_disk[k] = p
 	mkpath(os.path.dirname(profiles_db))
-	with open(profiles_db,'w') as f:
-		json.dump(to_disk, f, **json_args)
+	tmp = profiles_db + '.tmp'
+	with open(tmp, 'w') as f:
+		json.dump(profiles, f, **json_args)
+		f.flush()
+		os.fsync(f.fileno())
+	replace_file(tmp, profiles_db)
 	return
 
-# reads validated profiles from file.
+# reads validated profiles from snapshot file and replays changes recorded in its journal since then.
+# a torn record at the end of the journal from a crash mid-write is discarded.
 def read_profiles(profiles_db):
 	global logger_name
-	profiles = {}
+	from_disk = {}
 	if os.path.isfile(profiles_db) and os.path.getsize(profiles_db) > 0:
 		with open(profiles_db) as f:
 			from_disk = json.load(f)
-		for k, p in from_disk.iteritems():
+	journal = profiles_db + '.journal'
+	if os.path.isfile(journal):
+		with open(journal) as f:
+			for n, line in enumerate(f, 1):
+				try:
+					record = json.loads(line)
+				except ValueError:
+					logging.getLogger(logger_name).warning("Discarding Journal: Incomplete Record {0} in '{1}'".format(n, journal))
+					break
+				for k in record['delete']:
+					from_disk.pop(k, None)
+				from_disk.update(record['put'])
+	profiles = {}
+	for k, p in from_disk.iteritems():
+		validated, msg = validate_profile(k, p)
+		if not validated:
+			logging.getLogger(logger_name).warning("Discarding Profile: {0}".format(msg))
+			continue
+		profiles[k] = p
+	return profiles
+
+# finds where each profile is stored in the raw snapshot without validating it. returns name mapped to
+# [offset, length, digest], digest is a sha1 of the name and profile text used to cache validation results.
+def index_profiles(data):
+	ws = re.compile(r'[ \t\n\r]*')
+	decoder = json.JSONDecoder()
+	index = {}
+	i = ws.match(data, 0).end()
+	if data[i:i + 1] != '{':
+		raise ValueError("Expecting Object at Start of Snapshot")
+	i = ws.match(data, i + 1).end()
+	while data[i:i + 1] != '}':
+		if data[i:i + 1] != '"':
+			raise ValueError("Expecting Profile Name at Character {0}".format(i))
+		k, i = json.decoder.scanstring(data, i + 1)
+		i = ws.match(data, i).end()
+		if data[i:i + 1] != ':':
+			raise ValueError("Expecting ':' at Character {0}".format(i))
+		i = ws.match(data, i + 1).end()
+		end = decoder.raw_decode(data, i)[1]
+		index[k] = [i, end - i, hashlib.sha1(k.encode('utf-8') + '\0' + data[i:end]).hexdigest()]
+		i = ws.match(data, end).end()
+		if data[i:i + 1] == ',':
+			i = ws.match(data, i + 1).end()
+		elif data[i:i + 1] != '}':
+			raise ValueError("Expecting ',' or '}}' at Character {0}".format(i))
+	return index
+
+# profiles read on first access from the memory-mapped snapshot, so startup does not parse or validate
+# the whole file. where each profile is stored is kept in an index file next to the snapshot, along with
+# validation results by digest so a profile is only validated again once its text or the key codes change.
+class LazyProfiles(MutableMapping):
+	def __init__(self, profiles_db):
+		global valid_tokens
+		self.profiles_db = profiles_db
+		self.index_file = profiles_db + '.index'
+		self.lock = threading.RLock()
+		self.tokens = hashlib.sha1(macro_token_re.pattern + ' ' + ' '.join(sorted(valid_tokens))).hexdigest()
+		self.loaded = {}
+		self.unloaded = set()
+		self.index = {}
+		self.validated = {}
+		self.snapshot = None
+		self.mm = None
+		try:
+			with open(self.index_file) as f:
+				cached = json.load(f)
+			if cached['tokens'] == self.tokens:
+				self.validated = cached['validated']
+		except (IOError, ValueError, KeyError, TypeError):
+			cached = {}
+		self.open(cached)
+		self.replay()
+	# maps snapshot and reads its index, building the index again if the snapshot has changed since.
+	def open(self, cached={}):
+		self.close()
+		self.index = {}
+		if os.path.isfile(self.profiles_db) and os.path.getsize(self.profiles_db) > 0:
+			self.snapshot = open(self.profiles_db, 'rb')
+			self.mm = mmap.mmap(self.snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+			st = os.fstat(self.snapshot.fileno())
+			self.stamp = [st.st_size, st.st_mtime]
+			if cached.get('snapshot') == self.stamp:
+				self.index = cached['profiles']
+			else:
+				self.index = index_profiles(self.mm[:])
+				# after compaction the snapshot was just written from profiles already validated
+				for k in self.loaded:
+					if k in self.index:
+						self.validated[self.index[k][2]] = None
+				self.save()
+		self.unloaded = set(self.index) - set(self.loaded)
+		return
+	def close(self):
+		if self.mm:
+			self.mm.close()
+			self.snapshot.close()
+		self.mm = self.snapshot = None
+		return
+	# changes recorded in the journal are few, so they are validated as they are replayed. a record torn by a
+	# crash is cut off the journal, records appended after it would be lost behind it on the next replay.
+	def replay(self):
+		global logger_name
+		journal = self.profiles_db + '.journal'
+		if not os.path.isfile(journal):
+			return
+		good = 0
+		with open(journal, 'rb') as f:
+			for n, line in enumerate(f, 1):
+				try:
+					record = json.loads(line)
+				except ValueError:
+					logging.getLogger(logger_name).warning("Discarding Journal: Incomplete Record {0} in '{1}'".format(n, journal))
+					break
+				good += len(line)
+				for k in record['delete']:
+					self.unloaded.discard(k)
+					self.loaded.pop(k, None)
+				for k, p in record['put'].iteritems():
+					self.unloaded.discard(k)
+					self.loaded.pop(k, None)
+					validated, msg = validate_profile(k, p)
+					if not validated:
+						logging.getLogger(logger_name).warning("Discarding Profile: {0}".format(msg))
+						continue
+					self.loaded[k] = p
+			f.seek(0, os.SEEK_END)
+			size = f.tell()
+			if good:
+				f.seek(good - 1)
+				ended = f.read(1) == '\n'
+		if good < size:
+			with open(journal, 'r+b') as f:
+				f.truncate(good)
+		if good and not ended:
+			with open(journal, 'ab') as f:
+				f.write('\n')
+		return
+	# parses and validates profile from snapshot, skipping validation if its digest was seen before.
+	def load(self, k):
+		global logger_name
+		offset, length, digest = self.index[k]
+		self.unloaded.discard(k)
+		p = json.loads(self.mm[offset:offset + length])
+		if digest not in self.validated:
 			validated, msg = validate_profile(k, p)
-			if not validated:
-				logging.getLogger(logger_name).warning("Discarding Profile: {0}".format(msg))
+			self.validated[digest] = None if validated else msg
+		if self.validated[digest]:
+			logging.getLogger(logger_name).warning("Discarding Profile: {0}".format(self.validated[digest]))
+			return
+		self.loaded[k] = p
+		return
+	# writes index with validation results of profiles still in the snapshot.
+	def save(self):
+		if not self.mm:
+			return
+		digests = set(v[2] for v in self.index.itervalues())
+		validated = {d:v for d, v in self.validated.iteritems() if d in digests}
+		write_profiles({'snapshot':self.stamp, 'tokens':self.tokens, 'profiles':self.index, 'validated':validated}, self.index_file, {'separators':(',',':')})
+		return
+	def __getitem__(self, k):
+		with self.lock:
+			if k in self.unloaded:
+				self.load(k)
+			return self.loaded[k]
+	def __contains__(self, k):
+		try:
+			self[k]
+		except KeyError:
+			return False
+		return True
+	def __setitem__(self, k, p):
+		with self.lock:
+			self.unloaded.discard(k)
+			self.loaded[k] = p
+	def __delitem__(self, k):
+		with self.lock:
+			if k not in self.loaded and k not in self.unloaded:
+				raise KeyError(k)
+			self.unloaded.discard(k)
+			self.loaded.pop(k, None)
+	# loads profiles not validated before so invalid ones are known, others stay unloaded.
+	def load_unvalidated(self):
+		for k in [k for k in self.unloaded if self.index[k][2] not in self.validated]:
+			self.load(k)
+		return
+	def __iter__(self):
+		with self.lock:
+			self.load_unvalidated()
+			return iter(self.loaded.keys() + [k for k in self.unloaded if not self.validated.get(self.index[k][2])])
+	# counted the same way as __iter__ so invalid profiles are left out of both.
+	def __len__(self):
+		with self.lock:
+			self.load_unvalidated()
+			return len(self.loaded) + sum(1 for k in self.unloaded if not self.validated.get(self.index[k][2]))
+
+# appends validated profile changes to the journal as one record, so only what changed is written, and then
+# applies them in memory along with their compiled programs. a change is only made live once it is on disk,
+# a failed write leaves the profiles as they were. journal is compacted into a new snapshot once it reaches
+# journal_limit records. programs are compiled before anything is changed.
+def commit_profiles(put={}, delete=[]):
+	global profiles, programs, profiles_db, profiles_lock, journal_entries, journal_limit
+	compiled = {k:compile_profile(p) for k, p in put.iteritems()}
+	record = json.dumps({'put':put, 'delete':delete}, separators=(',',':')) + '\n'
+	with profiles_lock:
+		mkpath(os.path.dirname(profiles_db))
+		# written unbuffered so a failed write can be undone, nothing is left to flush on close
+		with open(profiles_db + '.journal', 'ab') as f:
+			size = os.fstat(f.fileno()).st_size
+			try:
+				written = 0
+				while written < len(record):
+					written += os.write(f.fileno(), record[written:])
+				os.fsync(f.fileno())
+			except OSError:
+				# part of the record may have been written, records appended after it would be lost on replay
+				os.ftruncate(f.fileno(), size)
+				raise
+		for k in delete:
+			profiles.pop(k, None)
+			programs.pop(k, None)
+		profiles.update(put)
+		programs.update(compiled)
+		invalidate_resources(('profiles',), ('status',), *[('profile', k) for k in delete + put.keys()])
+		journal_entries += 1
+		if journal_entries >= journal_limit:
+			compact_profiles()
+	return
+
+# writes snapshot of profiles in memory and removes the journal it replaces.
+def compact_profiles():
+	global profiles, profiles_db, profiles_lock, journal_entries, json_args, lazy_profiles
+	with profiles_lock:
+		# lazy profiles are all read before their snapshot is unmapped and replaced
+		snapshot = dict(profiles)
+		if lazy_profiles:
+			profiles.close()
+		write_profiles(snapshot, profiles_db, json_args)
+		if os.path.isfile(profiles_db + '.journal'):
+			os.remove(profiles_db + '.journal')
+		journal_entries = 0
+		if lazy_profiles:
+			profiles.open()
+	return
+
+# compiled form of a macro. steps are replayed in order, holdable if macro is a single key or single combo.
+# timing is None to use the key duration and gap of the job, otherwise (hold, gap) in seconds for each step.
+MacroProgram = namedtuple('MacroProgram', 'steps, holdable, timing')
+MacroProgram.__new__.__defaults__ = (None,)
+# one key or combo group with scan codes and keybd_event flags precomputed for press and release.
+KeyStep = namedtuple('KeyStep', 'codes, down, up')
+# step of a wait, nothing is pressed.
+empty_step = KeyStep(array('H'), array('H'), array('H'))
+
+# interns key codes into parallel arrays of scan codes and press/release flags indexed by key number, with
+# a shared single key step for each. key_codes.json stays the source of truth, this is rebuilt at start up.
+def intern_key_codes(key_codes):
+	global KEYEVENTF
+	names = sorted(key_codes)
+	index = {k:i for i, k in enumerate(names)}
+	scancodes = array('H')
+	down = array('H')
+	up = array('H')
+	for k in names:
+		flags = KEYEVENTF.SCANCODE
+		if key_codes[k]['e0'] == 1:
+			flags |= KEYEVENTF.EXTENDEDKEY
+		scancodes.append(key_codes[k]['sc'])
+		down.append(flags | KEYEVENTF.KEYDOWN)
+		up.append(flags | KEYEVENTF.KEYUP)
+	steps = tuple(KeyStep(scancodes[i:i + 1], down[i:i + 1], up[i:i + 1]) for i in xrange(len(names)))
+	return index, scancodes, down, up, steps
+
+# resolves key numbers into scan codes and press/release flags. single keys share the interned step.
+def compile_step(keys):
+	global key_scancodes, key_down, key_up, key_steps
+	if len(keys) == 1:
+		return key_steps[keys[0]]
+	return KeyStep(array('H', [key_scancodes[i] for i in keys]), array('H', [key_down[i] for i in keys]), array('H', [key_up[i] for i in keys]))
+
+# compiles validated macro into flat immutable program so execution never touches the tokenizer. waits are
+# steps without keys, references are resolved to compiled programs by resolve and copied in place.
+def compile_macro(m, resolve=None):
+	global key_index, key_steps, key_combo_seps, key_duration, key_gap, valid_tokens
+	duration, gap = key_duration, key_gap
+	if isinstance(m, dict):
+		duration = m.get('key_duration', duration)
+		gap = m.get('key_gap', gap)
+		m = m['keys']
+	custom = (duration, gap) != (key_duration, key_gap)
+	tokens = m.split()
+	steps = []
+	timing = []
+	combo = array('H')
+	open_combo = False
+	for i, k in enumerate(tokens):
+		hold, after = duration, gap
+		count = 1
+		if k not in valid_tokens:
+			t = macro_token_re.match(k)
+			k = tokens[i] = t.group(1)
+			count = int(t.group(4) or 1)
+			if t.group(2):
+				hold = float(t.group(2)) / 1000
+				if t.group(3):
+					after = float(t.group(3)) / 1000
+				custom = True
+			if k[0] == '~':
+				steps.extend([empty_step] * count)
+				timing.extend([(0.0, float(k[1:]) / 1000)] * count)
+				custom = True
 				continue
-			profiles[k] = p
-	return profiles
+			if k[0] == '&':
+				program = resolve(urllib.unquote(k[1:]))
+				steps.extend(program.steps * count)
+				timing.extend((program.timing or ((key_duration, key_gap),) * len(program.steps)) * count)
+				custom = custom or program.timing is not None
+				continue
+		if k == key_combo_seps['open']:
+			open_combo = True
+			continue
+		if k == key_combo_seps['close']:
+			open_combo = False
+			# empty combo group has nothing to press
+			if combo:
+				steps.extend([compile_step(combo)] * count)
+				timing.extend([(hold, after)] * count)
+				combo = array('H')
+			continue
+		if open_combo:
+			combo.append(key_index[k])
+		else:
+			steps.extend([key_steps[key_index[k]]] * count)
+			timing.extend([(hold, after)] * count)
+	# only allow 'press and hold' if macro is single combo or single key press
+	holdable = (len(steps) == 1 and len(steps[0].codes) > 0 and
+		(len(tokens) == 1 or
+		(tokens.count(key_combo_seps['open']) == 1 and
+		tokens[0] == key_combo_seps['open'] and
+		tokens.count(key_combo_seps['close']) == 1 and
+		tokens[-1] == key_combo_seps['close'])))
+	return MacroProgram(tuple(steps), holdable, tuple(timing) if custom else None)
+
+# names of macros referenced by macro.
+def macro_references(m):
+	if isinstance(m, dict):
+		m = m['keys']
+	return [urllib.unquote(t.group(1)[1:]) for t in (macro_token_re.match(k) for k in m.split() if k[0] == '&')]
+
+# compiles all macros of validated profile, each macro once even when referenced by others. macros are
+# compiled after those they reference without recursion, so long chains of references compile like any other.
+def compile_profile(p):
+	programs = {}
+	for root in p:
+		stack = [root]
+		while stack:
+			n = stack[-1]
+			if n in programs:
+				stack.pop()
+				continue
+			pending = [r for r in macro_references(p[n]) if r not in programs]
+			if pending:
+				stack.extend(pending)
+			else:
+				programs[n] = compile_macro(p[n], programs.__getitem__)
+				stack.pop()
+	return programs
+
+# SendInput structures. union includes mouse and hardware input so INPUT has the size windows expects.
+class KEYBDINPUT(ctypes.Structure):
+	_fields_ = [('wVk', ctypes.c_uint16), ('wScan', ctypes.c_uint16), ('dwFlags', ctypes.c_uint32), ('time', ctypes.c_uint32), ('dwExtraInfo', ctypes.c_void_p)]
+
+class MOUSEINPUT(ctypes.Structure):
+	_fields_ = [('dx', ctypes.c_int32), ('dy', ctypes.c_int32), ('mouseData', ctypes.c_uint32), ('dwFlags', ctypes.c_uint32), ('time', ctypes.c_uint32), ('dwExtraInfo', ctypes.c_void_p)]
+
+class HARDWAREINPUT(ctypes.Structure):
+	_fields_ = [('uMsg', ctypes.c_uint32), ('wParamL', ctypes.c_uint16), ('wParamH', ctypes.c_uint16)]
+
+class INPUT_UNION(ctypes.Union):
+	_fields_ = [('mi', MOUSEINPUT), ('ki', KEYBDINPUT), ('hi', HARDWAREINPUT)]
+
+class INPUT(ctypes.Structure):
+	_fields_ = [('type', ctypes.c_uint32), ('u', INPUT_UNION)]
+
+INPUT_KEYBOARD = 1
+
+# high resolution monotonic-enough clock for timing key events.
+clock = time.clock if sys.platform == 'win32' else time.time
+
+# key injection backends. send() receives one batch of scan codes with matching flags,
+# the whole batch is either all key downs or all key ups of a macro step. constructors
+# raise RuntimeError when the backend is not available on this platform.
+
+# injects whole batch as a single INPUT array with one SendInput call.
+class SendInputBackend(object):
+	name = 'sendinput'
+	def __init__(self):
+		if not hasattr(ctypes, 'windll'):
+			raise RuntimeError('SendInput Requires Windows')
+		self.send_input = ctypes.windll.user32.SendInput
+		self.size = ctypes.sizeof(INPUT)
+
+	def send(self, codes, flags):
+		global logger_name
+		n = len(codes)
+		inputs = (INPUT * n)()
+		for i in xrange(n):
+			inputs[i].type = INPUT_KEYBOARD
+			inputs[i].u.ki.wScan = codes[i]
+			inputs[i].u.ki.dwFlags = flags[i]
+		sent = self.send_input(n, inputs, self.size)
+		if sent != n:
+			logging.getLogger(logger_name).warning("SendInput Blocked: Sent {0} of {1} Key Events".format(sent, n))
+		return
+
+# injects one keybd_event call per key, kept for comparison with SendInput.
+class KeybdEventBackend(object):
+	name = 'keybd_event'
+	def __init__(self):
+		if win32api is None:
+			raise RuntimeError('keybd_event Requires pywin32')
+
+	def send(self, codes, flags):
+		for sc, f in zip(codes, flags):
+			win32api.keybd_event(0, sc, f, 0)
+		return
+
+# records key events in memory instead of injecting them. events are (timestamp, scan code, flags)
+# in the order they were sent, batches keep the grouping. used for load testing and checking event order.
+class RecordingBackend(object):
+	name = 'recording'
+	def __init__(self, now=clock):
+		self.now = now
+		self.reset()
+
+	def reset(self):
+		self.events = []
+		self.batches = []
+		return
+
+	def send(self, codes, flags):
+		t = self.now()
+		batch = zip(codes, flags)
+		self.events.extend((t, sc, f) for sc, f in batch)
+		self.batches.append(batch)
+		return
+
+# discards key events, measures the HTTP layer without any injection cost.
+class NullBackend(object):
+	name = 'null'
+	def send(self, codes, flags):
+		return
+
+key_backends = {b.name:b for b in [SendInputBackend, KeybdEventBackend, RecordingBackend, NullBackend]}
 
 # reads key codes from file.
 def read_key_codes(codes_file):
@@ -107,31 +680,783 @@ def read_key_codes(codes_file):
 	with open(codes_file) as f:
 		return json.load(f)
 
-# simulate key presses for given key codes.
-def press_keys(duration, keys=[], press=True, release=True):
-	global KEYEVENTF
-	if press:
-		for k in keys:
-			flags = KEYEVENTF.SCANCODE | KEYEVENTF.KEYDOWN
-			if k['e0'] == 1:
-				flags |= KEYEVENTF.EXTENDEDKEY
-			win32api.keybd_event(0, k['sc'], flags, 0)
-		time.sleep(duration)
-	if release:
-		for k in keys:
-			flags = KEYEVENTF.SCANCODE | KEYEVENTF.KEYUP
-			if k['e0'] == 1:
-				flags |= KEYEVENTF.EXTENDEDKEY
-			win32api.keybd_event(0, k['sc'], flags, 0)
+# expands compiled program into key event batches as (offset, codes, flags) with offsets relative to
+# the start of the macro. keys are held for duration and each step is followed by gap, unless the program
+# has its own timing for each step.
+def macro_events(program, duration, gap, press=True, release=True):
+	events = []
+	t = 0.0
+	for step, (hold, after) in itertools.izip(program.steps, program.timing or itertools.repeat((duration, gap))):
+		if press:
+			events.append((t, step.codes, step.down))
+			t += hold
+		if release:
+			events.append((t, step.codes, step.up))
+		t += after
+	return events, t
+
+# waits for absolute deadlines on clock. sleep alone overshoots by up to a scheduler tick, so it sleeps until
+# spin seconds before the deadline and yields in a loop for the rest. on windows the timer resolution is
+# raised to 1 ms for as long as the server runs. waits return True as soon as interrupt is set.
+class PrecisionTimer(object):
+	def __init__(self, spin=0.002):
+		self.spin = spin
+		self.now = clock
+		if sys.platform == 'win32':
+			ctypes.windll.winmm.timeBeginPeriod(1)
+			atexit.register(ctypes.windll.winmm.timeEndPeriod, 1)
+
+	def wait_until(self, deadline, interrupt=None):
+		remaining = deadline - clock()
+		if remaining > self.spin:
+			if interrupt is None:
+				time.sleep(remaining - self.spin)
+			elif interrupt.wait(remaining - self.spin):
+				return True
+		while clock() < deadline:
+			if interrupt is not None and interrupt.is_set():
+				return True
+			time.sleep(0)
+		return False
+
+# clock that only moves when waited on, so macro timing can be checked without sleeping.
+class VirtualTimer(object):
+	def __init__(self, start=None):
+		self.t = clock() if start is None else start
+
+	def now(self):
+		return self.t
+
+	def wait_until(self, deadline, interrupt=None):
+		if interrupt is not None and interrupt.is_set():
+			return True
+		self.t = max(self.t, deadline)
+		return False
+
+# queued or running execution of a compiled macro.
+class MacroJob(object):
+	def __init__(self, id, profile, macro, program, duration, press=True, release=True, client=None, priority=0, gap=None):
+		self.id = id
+		self.profile = profile
+		self.macro = macro
+		self.program = program
+		self.duration = duration
+		self.gap = duration if gap is None else gap
+		# set to 'cancelled' or 'preempted' to stop the job, interrupt wakes the scheduler waiting on it
+		self.cancelled = None
+		self.interrupt = threading.Event()
+		self.press = press
+		self.release = release
+		self.client = client
+		self.priority = priority
+		# position among the jobs queued by one batch, None outside of a batch
+		self.batch = None
+		self.state = 'queued'
+		# stamped by the scheduler with its own timer, like started and finished
+		self.queued = None
+		self.started = None
+		self.finished = None
+		self.done = threading.Event()
+
+	def to_dict(self):
+		d = {'id':self.id, 'profile':self.profile, 'macro':self.macro, 'client':self.client, 'priority':self.priority, 'state':self.state}
+		if self.started is not None:
+			d['wait'] = self.started - self.queued
+		if self.finished is not None and self.started is not None:
+			d['duration'] = self.finished - self.started
+		return d
+
+# single thread that owns the keyboard. jobs run one at a time and key events are fired against absolute
+# deadlines so the request threads never sleep on macros. queue policies decide what happens to a job
+# submitted while another is queued or running:
+#   fifo     - run every job in submission order
+#   drop     - reject the job if the scheduler is busy
+#   coalesce - reuse an identical job that is still waiting in the queue
+#   priority - run jobs from clients with higher priority first, fifo within the same priority
+# hold and release jobs are never dropped or coalesced so held keys always get released. jobs of a batch
+# are never coalesced and only the first may be dropped, so a batch runs as written or not at all.
+queue_policies = ['fifo', 'drop', 'coalesce', 'priority']
+
+class InputScheduler(threading.Thread):
+	def __init__(self, backend, held, policy='fifo', timer=None, preempt=False):
+		threading.Thread.__init__(self, name='input-scheduler')
+		self.daemon = True
+		self.backend = backend
+		self.held = held
+		self.policy = policy
+		self.timer = timer or PrecisionTimer()
+		# running macro is cancelled when one from a client with higher priority is submitted
+		self.preempt = preempt
+		# lateness of recent key events behind their deadlines
+		self.lateness = deque(maxlen=1000)
+		self.cond = threading.Condition()
+		self.queue = []
+		self.queued = {}
+		self.seq = itertools.count()
+		self.current = None
+		self.running = True
+		self.stats = {'submitted':0, 'completed':0, 'dropped':0, 'coalesced':0, 'max_depth':0, 'total_wait':0.0, 'max_wait':0.0, 'cancelled':0, 'preempted':0, 'events':0, 'total_lateness':0.0, 'max_lateness':0.0}
+
+	# queues job according to policy. returns the job that will run, which may be an earlier identical
+	# job when coalescing, or None when the job was dropped.
+	def submit(self, job):
+		plain = job.press and job.release
+		key = (job.profile, job.macro)
+		with self.cond:
+			job.queued = self.timer.now()
+			self.stats['submitted'] += 1
+			current = self.current
+			preempt = plain and self.preempt and current and current.press and current.release and job.priority > current.priority
+			if plain and not preempt and not job.batch and self.policy == 'drop' and (self.current or self.queue):
+				self.stats['dropped'] += 1
+				job.state = 'dropped'
+				job.done.set()
+				return None
+			if plain and job.batch is None and self.policy == 'coalesce' and key in self.queued:
+				self.stats['coalesced'] += 1
+				return self.queued[key]
+			if plain and job.batch is None:
+				self.queued[key] = job
+			priority = -job.priority if self.policy == 'priority' else 0
+			if preempt:
+				self.cancel(current, 'preempted')
+				# job that preempted the running one runs next, ahead of jobs queued before it unless
+				# the queue is already ordered by priority
+				if self.policy != 'priority':
+					priority = float('-inf')
+			heapq.heappush(self.queue, (priority, next(self.seq), job))
+			self.stats['max_depth'] = max(self.stats['max_depth'], len(self.queue))
+			self.cond.notify()
+		return job
+
+	# cancels queued or running macro. a running macro stops before its next key event and releases the keys
+	# it pressed. hold and release jobs are not cancelled so held keys stay consistent. returns False if the
+	# job can not be cancelled.
+	def cancel(self, job, state='cancelled'):
+		with self.cond:
+			if not (job.press and job.release) or job.cancelled:
+				return False
+			if job.state == 'queued':
+				job.state = state
+				if self.queued.get((job.profile, job.macro)) is job:
+					del self.queued[(job.profile, job.macro)]
+				job.finished = self.timer.now()
+				job.done.set()
+			elif job.state == 'running':
+				job.cancelled = state
+				job.interrupt.set()
+			else:
+				return False
+			self.stats[state] += 1
+			self.cond.notify_all()
+		return True
+
+	def stop(self):
+		with self.cond:
+			self.running = False
+			self.cond.notify_all()
+		return
+
+	# snapshot of queue depth, wait times, and jitter of key events behind their deadlines.
+	def report(self):
+		with self.cond:
+			r = dict(self.stats)
+			r['policy'] = self.policy
+			r['depth'] = len(self.queue)
+			r['busy'] = self.current is not None
+			lateness = sorted(self.lateness)
+		total_wait = r.pop('total_wait')
+		r['mean_wait'] = total_wait / r['completed'] if r['completed'] else 0.0
+		n = len(lateness)
+		events = r.pop('events')
+		r['jitter'] = {
+			'events':events,
+			'mean':r.pop('total_lateness') / events if events else 0.0,
+			'max':r.pop('max_lateness'),
+			'p50':lateness[n // 2] if n else 0.0,
+			'p99':lateness[min(n - 1, int(n * 0.99))] if n else 0.0
+		}
+		return r
+
+	def run(self):
+		global metrics
+		while True:
+			with self.cond:
+				while self.running and not self.queue:
+					self.cond.wait()
+				if not self.running:
+					return
+				job = heapq.heappop(self.queue)[2]
+				if self.queued.get((job.profile, job.macro)) is job:
+					del self.queued[(job.profile, job.macro)]
+				# cancelled while queued
+				if job.state != 'queued':
+					continue
+				job.state = 'running'
+				self.current = job
+			self.execute(job)
+			metrics.observe('macro_queue_wait_seconds', job.started - job.queued, profile=job.profile or '', macro=job.macro or '')
+			metrics.observe('macro_inject_seconds', job.finished - job.started, profile=job.profile or '', macro=job.macro or '')
+			with self.cond:
+				self.current = None
+				wait = job.started - job.queued
+				self.stats['completed'] += 1
+				self.stats['total_wait'] += wait
+				self.stats['max_wait'] = max(self.stats['max_wait'], wait)
+				self.cond.notify_all()
+
+	# blocks until every queued job has run.
+	def drain(self):
+		with self.cond:
+			while self.running and (self.queue or self.current):
+				self.cond.wait()
+		return
+
+	def execute(self, job):
+		global logger_name, metrics
+		job.state = 'running'
+		job.started = self.timer.now()
+		events, length = macro_events(job.program, job.duration, job.gap, job.press, job.release)
+		plain = job.press and job.release
+		# keys pressed by this job and not released yet, by the step they belong to
+		pressed = {}
+		try:
+			for offset, codes, flags in events:
+				step = id(codes)
+				# waits have no keys, only their timing
+				if plain and codes and flags[0] & KEYEVENTF.KEYUP:
+					codes, flags = self.held.filter_up(codes, flags)
+				if not codes:
+					continue
+				deadline = job.started + offset
+				if self.timer.wait_until(deadline, job.interrupt):
+					break
+				late = self.timer.now() - deadline
+				self.backend.send(codes, flags)
+				if flags[0] & KEYEVENTF.KEYUP:
+					pressed.pop(step, None)
+				else:
+					pressed[step] = (codes, flags)
+				with self.cond:
+					self.lateness.append(late)
+					self.stats['events'] += 1
+					self.stats['total_lateness'] += late
+					self.stats['max_lateness'] = max(self.stats['max_lateness'], late)
+				metrics.observe('key_event_lateness_seconds', late)
+			if job.cancelled:
+				for codes, flags in pressed.values():
+					flags = array('H', [f | KEYEVENTF.KEYUP for f in flags])
+					if plain:
+						codes, flags = self.held.filter_up(codes, flags)
+					if codes:
+						self.backend.send(codes, flags)
+				job.state = job.cancelled
+			else:
+				# keep trailing gap so the next job does not run into this one
+				self.timer.wait_until(job.started + length, job.interrupt)
+				job.state = job.cancelled or 'done'
+		except Exception as e:
+			logging.getLogger(logger_name).error("Macro Failed: Macro '{0}' in Profile '{1}': {2}".format(job.macro, job.profile, e))
+			job.state = 'failed'
+		job.finished = self.timer.now()
+		job.done.set()
+		return
+
+# thread-safe table of held keys. held macros are indexed by (profile, macro) and keep the client that
+# holds them along with the keys that were pressed at the time. individual keys are indexed by scan code
+# and flags with a reference count, so a key shared by overlapping holds is only released by the last one.
+# lock is reentrant so callers can hold it while queueing the job, keeping hold and release jobs in the
+# same order as the table changes.
+class HeldKeys(object):
+	def __init__(self):
+		self.lock = threading.RLock()
+		self.macros = {}
+		self.keys = {}
+		self.seen = {}
+
+	def is_held(self, m):
+		return m in self.macros
+
+	# adds macro holding the keys of step, returns step with only the keys that are not already down.
+	def hold(self, m, step, client):
+		with self.lock:
+			self.macros[m] = {'client':client, 'step':step, 'since':datetime.datetime.now()}
+			self.seen[client] = clock()
+			pressed = KeyStep(array('H'), array('H'), array('H'))
+			for sc, down, up in zip(step.codes, step.down, step.up):
+				n = self.keys.get((sc, down), 0)
+				self.keys[(sc, down)] = n + 1
+				if not n:
+					pressed.codes.append(sc)
+					pressed.down.append(down)
+					pressed.up.append(up)
+			return pressed
+
+	# removes held macro, returns step with only the keys no other hold still needs.
+	def release(self, m):
+		with self.lock:
+			held = self.macros.pop(m)
+			released = KeyStep(array('H'), array('H'), array('H'))
+			for sc, down, up in zip(held['step'].codes, held['step'].down, held['step'].up):
+				n = self.keys.pop((sc, down)) - 1
+				if n:
+					self.keys[(sc, down)] = n
+				else:
+					released.codes.append(sc)
+					released.down.append(down)
+					released.up.append(up)
+			if not any(h['client'] == held['client'] for h in self.macros.itervalues()):
+				self.seen.pop(held['client'], None)
+			return released
+
+	# removes all held macros, or only those held by client, returns step releasing their keys.
+	def release_all(self, client=None):
+		with self.lock:
+			released = KeyStep(array('H'), array('H'), array('H'))
+			for m in [m for m, h in self.macros.iteritems() if client is None or h['client'] == client]:
+				step = self.release(m)
+				released.codes.extend(step.codes)
+				released.down.extend(step.down)
+				released.up.extend(step.up)
+			return released
+
+	# records activity for client that holds keys.
+	def touch(self, client):
+		if client in self.seen:
+			self.seen[client] = clock()
+		return
+
+	# clients holding keys that have been inactive longer than timeout seconds.
+	def expired(self, timeout):
+		with self.lock:
+			now = clock()
+			return [c for c, t in self.seen.iteritems() if now - t > timeout]
+
+	# drops key ups for keys that are held so a macro sharing a key with a hold does not release it early.
+	def filter_up(self, codes, flags):
+		if not self.keys:
+			return codes, flags
+		with self.lock:
+			keep = [i for i in xrange(len(codes)) if (codes[i], flags[i] ^ KEYEVENTF.KEYUP) not in self.keys]
+		if len(keep) == len(codes):
+			return codes, flags
+		return array('H', [codes[i] for i in keep]), array('H', [flags[i] for i in keep])
+
+	def to_dict(self):
+		with self.lock:
+			return {
+				'macros':[{'profile':m[0], 'macro':m[1], 'client':h['client'], 'since':h['since'].strftime('%c')} for m, h in self.macros.iteritems()],
+				'keys':[{'sc':k[0], 'count':n} for k, n in self.keys.iteritems()]
+			}
+
+# queues release of all held keys, or only those held by client. returns the job or None if nothing was held.
+def release_held(client=None):
+	global held_keys, scheduler, job_ids, key_duration, key_gap
+	with held_keys.lock:
+		step = held_keys.release_all(client)
+		if not step.codes:
+			return None
+		return add_job(scheduler.submit(MacroJob(next(job_ids), None, None, MacroProgram((step,), True), key_duration, False, True, client, gap=key_gap)))
+
+# compiled program for macro, lazy profiles are compiled the first time one of their macros is used.
+def find_program(name, macro):
+	global profiles, programs, profiles_lock
+	if name not in programs:
+		with profiles_lock:
+			if name not in programs and name in profiles:
+				programs[name] = compile_profile(profiles[name])
+	return programs.get(name, {}).get(macro)
+
+# program followed by a wait in seconds, used to space out macros of a batch.
+def append_wait(program, wait):
+	global key_duration, key_gap
+	timing = program.timing or ((key_duration, key_gap),) * len(program.steps)
+	return MacroProgram(program.steps + (empty_step,), program.holdable, timing + ((0.0, wait),))
+
+# queues macro for client, shared by every transport. a held macro is released by the next request without
+# hold, release_only requests do nothing unless the macro is held. wait adds a pause in seconds after the
+# macro. returns status code with the queued job, which is None when there was nothing to do.
+def dispatch_macro(name, macro, client, hold=False, release_only=False, wait=0, batch=None):
+	global key_duration, key_gap, held_keys, metrics, clients
+	global scheduler, job_ids, client_priorities
+	global logger_name
+	program = find_program(name, macro)
+	if not program:
+		return 404, None
+	if hold and not program.holdable:
+		# only allow 'press and hold' if macro is single combo or single key press
+		logging.getLogger(logger_name).warning("Disregarding 'hold' Request for Macro {0} in Profile {1}".format(macro, name))
+		hold = False
+	m = (name, macro)
+	priority = client_priorities.get(client, 0)
+	with held_keys.lock:
+		if held_keys.is_held(m):
+			if hold:
+				return 200, None
+			job = MacroJob(next(job_ids), name, macro, MacroProgram((held_keys.release(m),), True), key_duration, False, True, client, priority, key_gap)
+		elif release_only:
+			return 200, None
+		elif hold:
+			job = MacroJob(next(job_ids), name, macro, MacroProgram((held_keys.hold(m, program.steps[0], client),), True), key_duration, True, False, client, priority, key_gap)
+		else:
+			job = MacroJob(next(job_ids), name, macro, program, key_duration, True, True, client, priority, key_gap)
+		if wait:
+			job.program = append_wait(job.program, wait)
+		job.batch = batch
+		job = scheduler.submit(job)
+	if job is None:
+		return 503, None
+	metrics.inc('macros_total', profile=name, macro=macro, client=client)
+	clients.touch(client, requests=0, macros=1)
+	return 200, add_job(job)
+
+# releases holds of clients that have made no authorized request within timeout seconds.
+def sweep_held_keys(timeout):
+	global held_keys, logger_name
+	while True:
+		time.sleep(max(timeout / 2.0, 1.0))
+		for client in held_keys.expired(timeout):
+			logging.getLogger(logger_name).warning("Client Timeout: Releasing Keys Held by '{0}'".format(client))
+			release_held(client)
+
+# drops clients from the registry that have made no request within their timeout.
+def sweep_clients():
+	global clients, logger_name
+	while True:
+		time.sleep(max(clients.timeout / 2.0, 1.0))
+		for client in clients.expire():
+			logging.getLogger(logger_name).info("Client Expired: '{0}'".format(client))
+
+# seconds start up waits for the server name to resolve before carrying on without it.
+resolve_timeout = 1.0
+
+# fills in fully qualified name and address of the server in the status document once they resolve.
+def resolve_server_name():
+	global status, logger_name
+	try:
+		name = socket.getfqdn()
+		address = socket.gethostbyname(name)
+	except socket.error as e:
+		logging.getLogger(logger_name).warning("Name Resolution Failed: {0}".format(e))
+		return
+	server = dict(status['server'])
+	server.update(name=name, address=address)
+	status['server'] = server
+	invalidate_resources(('status',))
 	return
 
-# checks for HTTP auth info in request.
-def authorized():
-	global auth_key
-	if not request.authorization or request.authorization.password != auth_key:
+# lets queued macros finish and then releases every held key.
+def drain_and_release():
+	global scheduler
+	scheduler.drain()
+	job = release_held()
+	if job:
+		job.done.wait()
+	return
+
+# last resort on interpreter exit, release anything still held directly through the backend.
+def release_held_at_exit():
+	global held_keys, key_backend
+	step = held_keys.release_all()
+	if step.codes:
+		key_backend.send(step.codes, step.up)
+	return
+
+# registers job so it can be looked up on /jobs/<id>, forgetting the oldest jobs past the limit.
+def add_job(job):
+	global jobs, jobs_lock, max_jobs
+	with jobs_lock:
+		jobs[job.id] = job
+		while len(jobs) > max_jobs:
+			jobs.popitem(last=False)
+	return job
+
+# serialized JSON bodies with content hash and time of creation, keyed by resource tuple. bodies are built
+# on first request and kept until the resource changes. building under the lock means an invalidation
+# can never be overtaken by a build that read the data before it changed.
+def cached_resource(key, build):
+	global resource_cache, cache_lock
+	with cache_lock:
+		if key not in resource_cache:
+			body = flask_json.dumps(build(), indent=2)
+			resource_cache[key] = (body, hashlib.sha1(body).hexdigest(), datetime.datetime.utcnow())
+		return resource_cache[key]
+
+# drops cached bodies of resources whose keys start with any of the given prefixes.
+def invalidate_resources(*prefixes):
+	global resource_cache, cache_lock
+	with cache_lock:
+		for key in resource_cache.keys():
+			if any(key[:len(p)] == p for p in prefixes):
+				del resource_cache[key]
+	return
+
+# resources with absolute urls are cached for each host name clients use, at most max_cached_hosts of them.
+max_cached_hosts = 4
+host_resources = ('status', 'profiles')
+
+# cached resource for the host name of the request, built again once older than max_age. entries of the
+# least recently used host are dropped once there are more than max_cached_hosts, so made up Host headers
+# can not grow the cache.
+def cached_host_resource(name, build, max_age=None):
+	global cached_hosts, cache_lock
+	host = request.host_url
+	key = (name, host)
+	with cache_lock:
+		if cached_hosts.pop(host, None) is None:
+			while len(cached_hosts) >= max_cached_hosts:
+				old = cached_hosts.popitem(last=False)[0]
+				invalidate_resources(*[(k, old) for k in host_resources])
+		cached_hosts[host] = True
+		entry = cached_resource(key, build)
+		if max_age is not None and datetime.datetime.utcnow() - entry[2] > max_age:
+			invalidate_resources(key)
+			entry = cached_resource(key, build)
+		return entry
+
+# serves cached body with ETag and Last-Modified headers, 304 when the client copy is current.
+def cached_response(entry):
+	body, etag, modified = entry
+	r = app.response_class(body, mimetype='application/json')
+	r.set_etag(etag)
+	r.last_modified = modified
+	return r.make_conditional(request)
+
+# bucket upper bounds in seconds shared by all latency histograms.
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# low overhead latency histograms and counters keyed by metric name and labels, exported in prometheus
+# text format. histograms keep per bucket counts followed by the total and sum, cumulated on export.
+class Metrics(object):
+	help = {
+		'request_seconds':('histogram', 'Total time to serve a request.'),
+		'request_parse_seconds':('histogram', 'Time from receiving a request to dispatching it to its endpoint.'),
+		'auth_seconds':('histogram', 'Time spent checking authorization.'),
+		'macro_queue_wait_seconds':('histogram', 'Time a macro waited in the input scheduler queue.'),
+		'macro_inject_seconds':('histogram', 'Time spent injecting the key events of a macro.'),
+		'key_event_lateness_seconds':('histogram', 'Time a key event was sent after its deadline.'),
+		'requests_total':('counter', 'Requests served.'),
+		'macros_total':('counter', 'Macros queued for execution.')
+	}
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.histograms = {}
+		self.counters = {}
+
+	def observe(self, name, seconds, **labels):
+		key = (name, tuple(sorted(labels.iteritems())))
+		i = bisect.bisect_left(latency_buckets, seconds)
+		with self.lock:
+			h = self.histograms.get(key)
+			if h is None:
+				h = self.histograms[key] = [0] * (len(latency_buckets) + 2) + [0.0]
+			h[i] += 1
+			h[-2] += 1
+			h[-1] += seconds
+		return
+
+	def inc(self, name, n=1, **labels):
+		key = (name, tuple(sorted(labels.iteritems())))
+		with self.lock:
+			self.counters[key] = self.counters.get(key, 0) + n
+		return
+
+	# totals of a metric summed over all labels, as (count, sum) for histograms.
+	def total(self, name):
+		with self.lock:
+			if name in self.help and self.help[name][0] == 'counter':
+				return sum(n for (k, l), n in self.counters.iteritems() if k == name)
+			h = [v for (k, l), v in self.histograms.iteritems() if k == name]
+			return sum(v[-2] for v in h), sum(v[-1] for v in h)
+
+	# largest counter values of a metric with their labels.
+	def top(self, name, n=5):
+		with self.lock:
+			c = [(v, dict(l)) for (k, l), v in self.counters.iteritems() if k == name]
+		return [dict(l, count=v) for v, l in sorted(c, reverse=True)[:n]]
+
+	def to_prometheus(self, gauges={}):
+		def fmt(labels):
+			if not labels:
+				return ''
+			return '{' + ','.join('{0}="{1}"'.format(k, unicode(v).encode('utf-8').replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels) + '}'
+		with self.lock:
+			histograms = sorted((k, list(v)) for k, v in self.histograms.iteritems())
+			counters = sorted(self.counters.iteritems())
+		lines = []
+		for name in sorted(self.help):
+			kind, text = self.help[name]
+			lines.append('# HELP pyrestvk_{0} {1}'.format(name, text))
+			lines.append('# TYPE pyrestvk_{0} {1}'.format(name, kind))
+			if kind == 'counter':
+				lines.extend('pyrestvk_{0}{1} {2}'.format(name, fmt(l), v) for (k, l), v in counters if k == name)
+				continue
+			for (k, l), h in histograms:
+				if k != name:
+					continue
+				n = 0
+				for bound, count in zip(latency_buckets + ('+Inf',), h):
+					n += count
+					lines.append('pyrestvk_{0}_bucket{1} {2}'.format(name, fmt(l + (('le', bound),)), n))
+				lines.append('pyrestvk_{0}_sum{1} {2!r}'.format(name, fmt(l), h[-1]))
+				lines.append('pyrestvk_{0}_count{1} {2}'.format(name, fmt(l), h[-2]))
+		for name, (text, value) in sorted(gauges.iteritems()):
+			lines.append('# HELP pyrestvk_{0} {1}'.format(name, text))
+			lines.append('# TYPE pyrestvk_{0} gauge'.format(name))
+			lines.append('pyrestvk_{0} {1}'.format(name, value))
+		return '\n'.join(lines) + '\n'
+
+# scopes granted by api keys. 'execute' runs, holds and releases macros and manages jobs, 'edit' also
+# changes profiles and shuts the service down.
+auth_scopes = {'execute':frozenset(['execute']), 'edit':frozenset(['execute', 'edit'])}
+
+# compares secrets in time independent of where they differ.
+def same_secret(a, b):
+	if isinstance(a, unicode):
+		a = a.encode('utf-8')
+	if isinstance(b, unicode):
+		b = b.encode('utf-8')
+	return hmac.compare_digest(a, b)
+
+Session = namedtuple('Session', 'client, scopes, secret, expires')
+
+# short lived session tokens issued on /auth. a token is '<id>.<secret>', the session is found by its id
+# and the secret compared in constant time, so checking a token costs the same however many are issued.
+class Sessions(object):
+	def __init__(self, timeout):
+		self.timeout = timeout
+		self.lock = threading.Lock()
+		self.sessions = {}
+
+	# returns token and its lifetime in seconds, dropping expired sessions. a token issued on another session
+	# expires with that session, so tokens cannot be renewed without the api key.
+	def issue(self, client, scopes, session=None):
+		now = time.time()
+		expires = session.expires if session is not None else now + self.timeout
+		sid, secret = os.urandom(8).encode('hex'), os.urandom(16).encode('hex')
+		with self.lock:
+			for k in [k for k, v in self.sessions.iteritems() if v.expires <= now]:
+				del self.sessions[k]
+			self.sessions[sid] = Session(client, scopes, secret, expires)
+		return '{0}.{1}'.format(sid, secret), expires - now
+
+	# returns session of a valid token, None otherwise.
+	def check(self, token):
+		sid, _, secret = token.partition('.')
+		s = self.sessions.get(sid)
+		if s is None or not same_secret(s.secret, secret) or s.expires <= time.time():
+			return None
+		return s
+
+	def __len__(self):
+		return len(self.sessions)
+
+# clients seen on authorized requests and channel frames, least recently seen first. the least recently seen
+# client is evicted to stay within limit, and clients idle longer than timeout are dropped by expire().
+class ClientRegistry(object):
+	def __init__(self, limit, timeout, changed=None):
+		self.limit = max(limit, 1)
+		self.timeout = timeout
+		self.changed = changed or (lambda: None)
+		self.lock = threading.Lock()
+		self.clients = OrderedDict()
+
+	# records activity of client with counts of requests, macros and bytes it sent and received.
+	def touch(self, name, address=None, requests=1, macros=0, size=0):
+		with self.lock:
+			c = self.clients.pop(name, None)
+			added = c is None
+			if added:
+				while len(self.clients) >= self.limit:
+					self.clients.popitem(last=False)
+				c = {'address':address, 'since':datetime.datetime.now(), 'requests':0, 'macros':0, 'bytes':0}
+			if address:
+				c['address'] = address
+			c['last_seen'] = datetime.datetime.now()
+			c['requests'] += requests
+			c['macros'] += macros
+			c['bytes'] += size
+			self.clients[name] = c
+		if added:
+			self.changed()
+		return
+
+	# drops clients idle longer than timeout, returns their names.
+	def expire(self):
+		cutoff = datetime.datetime.now() - datetime.timedelta(seconds=self.timeout)
+		with self.lock:
+			idle = list(itertools.takewhile(lambda k: self.clients[k]['last_seen'] < cutoff, self.clients))
+			for k in idle:
+				del self.clients[k]
+		if idle:
+			self.changed()
+		return idle
+
+	# copies of clients most recently seen first, from offset up to count of them.
+	def page(self, offset, count):
+		with self.lock:
+			names = list(itertools.islice(reversed(self.clients), offset, offset + count))
+			return [(k, dict(self.clients[k])) for k in names]
+
+	def __contains__(self, name):
+		return name in self.clients
+
+	def __len__(self):
+		return len(self.clients)
+
+# returns scopes of client's api key or session token, None if neither is valid. every key is compared
+# so the time taken does not tell which key came close.
+def credential_scopes(client, secret):
+	global sessions
+	s = sessions.check(secret)
+	if s is not None and s.client == client:
+		return s.scopes
+	return api_key_scopes(secret)
+
+# returns scopes of api key, None if it is not one.
+def api_key_scopes(secret):
+	global api_keys
+	scopes = None
+	for key, granted in api_keys:
+		if same_secret(key, secret):
+			scopes = granted
+	return scopes
+
+# checks HTTP auth info in request, either basic auth with an api key or session token as password or a
+# bearer session token. authenticated clients lacking scope are refused with 403 rather than 401.
+def authorized(scope='execute'):
+	global held_keys, metrics, sessions
+	t = clock()
+	client, scopes, s = None, None, None
+	header = request.headers.get('Authorization', '')
+	if header[:7].lower() == 'bearer ':
+		s = sessions.check(header[7:].strip())
+		if s is not None:
+			client, scopes = s.client, s.scopes
+	elif request.authorization:
+		client = request.authorization.username
+		s = sessions.check(request.authorization.password)
+		if s is not None and s.client == client:
+			scopes = s.scopes
+		else:
+			s = None
+			scopes = api_key_scopes(request.authorization.password)
+	metrics.observe('auth_seconds', clock() - t)
+	if scopes is None:
 		return False
+	request.environ['pyrestvk.client'] = client
+	request.environ['pyrestvk.scopes'] = scopes
+	request.environ['pyrestvk.session'] = s
+	if scope not in scopes:
+		abort(403)
+	held_keys.touch(client)
 	return True
 
+# name of the client authorized for this request.
+def client_name():
+	return request.environ.get('pyrestvk.client', '')
+
 
 app = Flask(__name__)
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
@@ -146,152 +1471,409 @@ def make_json_error(ex):
 for code in default_exceptions.iterkeys():
 	app.error_handler_spec[None][code] = make_json_error
 
-# root is readable to all and gives server status with clients and profiles summary.
+# stamps the time a request reached the application before flask parses and routes it.
+class ReceivedMiddleware(object):
+	def __init__(self, app):
+		self.app = app
+
+	def __call__(self, environ, start_response):
+		environ['pyrestvk.received'] = clock()
+		return self.app(environ, start_response)
+
+app.wsgi_app = ReceivedMiddleware(app.wsgi_app)
+
+@app.before_request
+def time_dispatch():
+	global metrics
+	request.environ['pyrestvk.dispatched'] = clock()
+	metrics.observe('request_parse_seconds', request.environ['pyrestvk.dispatched'] - request.environ['pyrestvk.received'], endpoint=request.endpoint or '')
+	return
+
+@app.after_request
+def time_request(response):
+	global metrics, clients
+	metrics.observe('request_seconds', clock() - request.environ['pyrestvk.received'], endpoint=request.endpoint or '', method=request.method)
+	metrics.inc('requests_total', endpoint=request.endpoint or '', client=client_name(), status=response.status_code)
+	if client_name():
+		clients.touch(client_name(), request.remote_addr, size=(request.content_length or 0) + (response.content_length or 0))
+	return response
+
+# seconds the queue depth and request metrics in the cached status document may lag behind.
+status_max_age = datetime.timedelta(seconds=1)
+
+# builds status document for the host name the client used.
+def build_status():
+	global status, profiles, clients, key_codes, scheduler, metrics
+	s = dict(status)
+	s['clients'] = {'url':url_for('client_list', _external=True), 'count':len(clients)}
+	s['profiles'] = {'url':url_for('register_profile', _external=True), 'count':len(profiles)}
+	s['key_codes'] = {'url':url_for('select_key_codes', _external=True), 'count':len(key_codes)}
+	s['jobs'] = {'url':url_for('job_list', _external=True), 'depth':scheduler.report()['depth']}
+	requests, seconds = metrics.total('request_seconds')
+	s['metrics'] = {
+		'url':url_for('server_metrics', _external=True),
+		'requests':requests,
+		'mean_request_ms':1000 * seconds / requests if requests else 0.0,
+		'macros':metrics.total('macros_total'),
+		'top_macros':metrics.top('macros_total')
+	}
+	return s
+
+# root is readable to all and gives server status with clients and profiles summary. the body is cached per
+# host name and built again when clients come or go, profiles change, the server name is resolved, or the
+# queue depth and metrics in it are older than status_max_age.
 @app.route('/')
 def server_status():
-	global status, profiles, clients, key_codes
-	status['clients'] = {'url':url_for('client_list', _external=True), 'count':len(clients)}
-	status['profiles'] = {'url':url_for('register_profile', _external=True), 'count':len(profiles)}
-	status['key_codes'] = {'url':url_for('select_key_codes', _external=True), 'count':len(key_codes)}
-	return jsonify(status)
+	return cached_response(cached_host_resource('status', build_status, status_max_age))
+
+# liveness probe for load balancers and monitors, without authentication or JSON. 503 once the input
+# scheduler has stopped.
+@app.route('/health')
+def server_health():
+	global scheduler
+	if not scheduler.is_alive():
+		return Response('Unavailable\n', status=503, mimetype='text/plain')
+	return Response('OK\n', mimetype='text/plain')
+
+# latency histograms and counters in prometheus text format, readable to all like the server status.
+@app.route('/metrics')
+def server_metrics():
+	global metrics, scheduler, held_keys, sessions, clients
+	r = scheduler.report()
+	gauges = {
+		'queue_depth':('Macros waiting in the input scheduler queue.', r['depth']),
+		'held_macros':('Macros currently held down.', len(held_keys.macros)),
+		'clients':('Clients in the client registry.', len(clients)),
+		'sessions':('Session tokens issued on /auth, expired ones are dropped on the next issue.', len(sessions))
+	}
+	return Response(metrics.to_prometheus(gauges), mimetype='text/plain; version=0.0.4')
 
 # adds authenticated client to list. not strictly necessary to perform authenticated tasks.
 @app.route('/auth')
 def register_client():
-	global clients
+	global sessions
 	if not authorized():
 		abort(401)
-	name = request.authorization.username
-	if name not in clients:
-		clients[name] = {'address':request.remote_addr, 'since':datetime.datetime.now()}
-	return jsonify(message='OK')
+	name = client_name()
+	# token is sent in place of the api key until it expires, with the same scopes. a token presented here
+	# only gets one expiring with it
+	scopes = request.environ['pyrestvk.scopes']
+	token, expires = sessions.issue(name, scopes, request.environ['pyrestvk.session'])
+	return jsonify(message='OK', token=token, expires=expires, scopes=sorted(scopes))
 
-# performs immediate shutdown.
+# runs queued macros, releases all held keys and then shuts down.
 @app.route('/shutdown')
 def server_shutdown():
-	if not authorized():
+	global http_server
+	if not authorized('edit'):
 		abort(401)
-	request.environ.get('werkzeug.server.shutdown')()
+	drain_and_release()
+	if http_server is not None:
+		# shutdown() waits for the accept loop to exit so it cannot run on this worker directly
+		threading.Thread(target=http_server.shutdown).start()
+	else:
+		request.environ.get('werkzeug.server.shutdown')()
 	return jsonify(message='OK')
 
-# list of authenticated clients that have registered on /auth.
+# authenticated clients most recently seen first, a page of up to limit at a time from offset. the next page
+# is linked in the Link header and the number of clients is given in X-Total-Count.
 @app.route('/clients')
 def client_list():
 	global clients
-	return jsonify(clients)
+	try:
+		offset = max(int(request.args.get('offset', 0)), 0)
+		limit = min(max(int(request.args.get('limit', 100)), 1), 1000)
+	except ValueError:
+		abort(400)
+	page = clients.page(offset, limit)
+	# a list keeps the order pages are taken in, the keys of an object would be sorted
+	r = jsonify(clients=[dict(c, name=k) for k, c in page])
+	r.headers['X-Total-Count'] = str(len(clients))
+	if offset + len(page) < len(clients):
+		r.headers['Link'] = '<{0}>; rel="next"'.format(url_for('client_list', offset=offset + limit, limit=limit, _external=True))
+	return r
 
 # list all profiles this server knows about and allow adding new ones.
 @app.route('/profiles', methods=['GET','POST'])
 def register_profile():
-	global profiles, profiles_db, json_args
+	global profiles, profiles_lock, profiles_db, journal_entries
 	if request.method == 'GET':
 		# client requested to download a copy of the entire server cache using /profiles?send_file=true
 		if request.args.get('send_file', '').lower() == 'true':
+			# snapshot must include journaled changes before it is sent
+			if journal_entries:
+				compact_profiles()
 			return send_file(profiles_db, as_attachment=True, attachment_filename=os.path.basename(profiles_db))
-		return jsonify({k:{'url':url_for('select_profile', name=k, _external=True), 'macros':len(profiles[k])} for k in profiles})
-	if not authorized():
+		# urls are absolute so the index is cached per host name the client used
+		return cached_response(cached_host_resource('profiles', lambda: {k:{'url':url_for('select_profile', name=k, _external=True), 'macros':len(profiles[k])} for k in profiles}))
+	if not authorized('edit'):
 		abort(401)
 	# allow clients to send profile data as file
 	if request.files:
 		profile = json.loads(request.files[request.files.keys()[0]].read())
 	else:
 		profile = request.json
+	# allow clients to validate any number of profiles without altering server cache using /profiles?validate_only=true
+	if request.args.get('validate_only', '').lower() == 'true':
+		errors = [e for k, p in profile.iteritems() for e in profile_errors(k, p)]
+		if errors:
+			return make_response(jsonify(message=errors[0]['message'], errors=errors), 400)
+		return jsonify(message='OK', count=len(profile))
 	k, p = next(profile.iteritems())
 	validated, msg = validate_profile(k, p)
 	if not validated:
 		return make_response(jsonify(message=msg), 400)
-	# allow clients to validate profile data without altering server cache using /profiles?validate_only=true
-	if request.args.get('validate_only', '').lower() == 'true':
-		return jsonify(message=msg)
-	if k in profiles:
-		return make_response(jsonify(message="Duplicate Entry: Profile '{0}' Exists".format(k)), 409)
-	profiles[k] = p
-	write_profiles(profiles, profiles_db, json_args)
+	with profiles_lock:
+		if k in profiles:
+			return make_response(jsonify(message="Duplicate Entry: Profile '{0}' Exists".format(k)), 409)
+		commit_profiles(put={k:p})
 	return make_response(jsonify(url=url_for('select_profile', name=k, _external=True)), 201, {'Location':url_for('select_profile', name=k)})
 
+# yields (name, profile) pairs from an upload as they are parsed. NDJSON is read one line at a time with
+# any number of profiles per line, otherwise the upload is a single JSON object of profiles like profiles.json.
+def read_bulk_profiles(stream, ndjson):
+	if not ndjson:
+		for k, p in json.load(stream).iteritems():
+			yield k, p
+		return
+	for line in stream:
+		if line.strip():
+			for k, p in json.loads(line).iteritems():
+				yield k, p
+
+# bulk import and streaming export of profiles. import is all or nothing, every profile is validated as it
+# streams in and all of them are committed with a single journal record.
+@app.route('/profiles/_bulk', methods=['GET','POST'])
+def bulk_profiles():
+	global profiles, profiles_lock
+	if request.method == 'GET':
+		# client requested one profile per line using /profiles/_bulk?format=ndjson
+		ndjson = request.args.get('format', '').lower() == 'ndjson'
+		with profiles_lock:
+			items = sorted(profiles.items())
+		def generate():
+			if not ndjson:
+				yield '{'
+			for i, (k, p) in enumerate(items):
+				if ndjson:
+					yield json.dumps({k:p}, sort_keys=True) + '\n'
+				else:
+					yield (',' if i else '') + json.dumps(k) + ':' + json.dumps(p, sort_keys=True)
+			if not ndjson:
+				yield '}'
+		r = Response(generate(), mimetype='application/x-ndjson' if ndjson else 'application/json')
+		# client requested to download export as file using /profiles/_bulk?send_file=true
+		if request.args.get('send_file', '').lower() == 'true':
+			r.headers['Content-Disposition'] = 'attachment; filename=profiles.' + ('ndjson' if ndjson else 'json')
+		return r
+	if not authorized('edit'):
+		abort(401)
+	# allow clients to send profiles as file
+	if request.files:
+		f = request.files[request.files.keys()[0]]
+		stream, ndjson = f.stream, f.filename.lower().endswith('.ndjson')
+	else:
+		stream, ndjson = request.stream, request.mimetype == 'application/x-ndjson'
+	put = {}
+	errors = []
+	try:
+		for k, p in read_bulk_profiles(stream, ndjson):
+			e = profile_errors(k, p)
+			if not e and k in put:
+				e = [{'profile':k, 'macro':None, 'position':None, 'message':"Duplicate Entry: Profile '{0}' Repeated in Upload".format(k)}]
+			if e:
+				errors.extend(e)
+			else:
+				put[k] = p
+	except (ValueError, AttributeError) as e:
+		return make_response(jsonify(message="Invalid Upload: {0}".format(e)), 400)
+	if errors:
+		return make_response(jsonify(message=errors[0]['message'], errors=errors), 400)
+	if not put:
+		return make_response(jsonify(message="Upload Empty: No Profiles"), 400)
+	# allow clients to validate profiles without altering server cache using /profiles/_bulk?validate_only=true
+	if request.args.get('validate_only', '').lower() == 'true':
+		return jsonify(message='OK', count=len(put))
+	# existing profiles are only overwritten using /profiles/_bulk?replace=true
+	replace = request.args.get('replace', '').lower() == 'true'
+	with profiles_lock:
+		existing = [k for k in put if k in profiles]
+		if existing and not replace:
+			errors = [{'profile':k, 'macro':None, 'position':None, 'message':"Duplicate Entry: Profile '{0}' Exists".format(k)} for k in existing]
+			return make_response(jsonify(message=errors[0]['message'], errors=errors), 409)
+		commit_profiles(put=put)
+	return jsonify(message='OK', profiles={k:{'url':url_for('select_profile', name=k, _external=True), 'replaced':k in existing} for k in put})
+
 # retrieve profile in format that is acceptable to post back as new after delete. allow put for updates.
 @app.route('/profiles/<name>', methods=['GET','PUT','DELETE'])
 def select_profile(name):
-	global profiles, profiles_db, json_args
+	global profiles, profiles_lock, json_args
 	if name not in profiles:
 		abort(404)
+	entry = cached_resource(('profile', name), lambda: {name:profiles[name]})
 	if request.method == 'GET':
-		p = {name:profiles[name]}
 		# client requested to download a copy of the profile as file using /profiles/<name>?send_file=true
 		if request.args.get('send_file', '').lower() == 'true':
-			return send_file(StringIO.StringIO(json.dumps(p, **json_args)), as_attachment=True, attachment_filename=name + '.json')
-		return jsonify(p)
-	if not authorized():
+			return send_file(StringIO.StringIO(json.dumps({name:profiles[name]}, **json_args)), as_attachment=True, attachment_filename=name + '.json')
+		return cached_response(entry)
+	if not authorized('edit'):
 		abort(401)
-	if request.method == 'DELETE':
-		profiles.pop(name, None)
-		write_profiles(profiles, profiles_db, json_args)
-		return make_response('', 204)
-	# allow clients to send profile data as file
-	if request.files:
-		x = json.loads(request.files[request.files.keys()[0]].read())
-	else:
-		x = request.json
-	k, p = next(x.iteritems())
-	validated, msg = validate_profile(k, p)
-	if not validated:
-		return make_response(jsonify(message=msg), 400)
-	if k != name and k in profiles:
-		return make_response(jsonify(message="Duplicate Entry: Profile '{0}' Exists".format(k)), 409)
-	profiles.pop(name, None)
-	profiles[k] = p
-	write_profiles(profiles, profiles_db, json_args)
+	# checks and change are made under the lock so concurrent changes of the same profile apply one at a time
+	with profiles_lock:
+		if name not in profiles:
+			abort(404)
+		entry = cached_resource(('profile', name), lambda: {name:profiles[name]})
+		# client sent If-Match with ETag of the copy it expects to change
+		if request.if_match and entry[1] not in request.if_match:
+			return make_response(jsonify(message="Precondition Failed: Profile '{0}' Has Changed".format(name)), 412)
+		if request.method == 'DELETE':
+			commit_profiles(delete=[name])
+			return make_response('', 204)
+		# allow clients to send profile data as file
+		if request.files:
+			x = json.loads(request.files[request.files.keys()[0]].read())
+		else:
+			x = request.json
+		k, p = next(x.iteritems())
+		validated, msg = validate_profile(k, p)
+		if not validated:
+			return make_response(jsonify(message=msg), 400)
+		if k != name and k in profiles:
+			return make_response(jsonify(message="Duplicate Entry: Profile '{0}' Exists".format(k)), 409)
+		commit_profiles(put={k:p}, delete=[name])
 	if k != name:
 		return make_response(jsonify(url=url_for('select_profile', name=k, _external=True)), 201, {'Location':url_for('select_profile', name=k)})
 	return make_response('', 204)
 
-# authenticated execution of macro key sequences. minimal validation since it should have passed validation twice by now.
+# authenticated execution of compiled macro programs. no parsing or validation since it was done when the profile was accepted.
 @app.route('/profiles/<name>/<macro>')
 def select_macro(name, macro):
-	global profiles, key_codes, key_duration, key_combo_seps, held_macros
-	global logger_name
+	global async_macros
 	if not authorized():
 		abort(401)
-	if name not in profiles or macro not in profiles[name]:
+	# client requested 'press and hold' using ?hold=true, or to only release a held macro using ?release=true
+	code, job = dispatch_macro(name, macro, client_name(), request.args.get('hold', '').lower() == 'true', request.args.get('release', '').lower() == 'true')
+	if code == 404:
 		abort(404)
-	m = profiles[name][macro].split()
-	press = True
-	release = True
-	if m in held_macros:
-		press = False
-	# client requested 'press and hold' using ?hold=true
-	if request.args.get('hold', '').lower() == 'true':
-		if (len(m) == 1 or
-			(m.count(key_combo_seps['open']) == 1 and
-			m[0] == key_combo_seps['open'] and
-			m.count(key_combo_seps['close']) == 1 and
-			m[-1] == key_combo_seps['close'])):
-			release = False
-			if press:
-				held_macros.append(m)
-		else:
-			# only allow 'press and hold' if macro is single combo or single key press
-			logging.getLogger(logger_name).warning("Disregarding 'hold' Request for Macro {0} in Profile {1}".format(macro, name))
-	if release and not press:
-		held_macros.remove(m)
-	combo = []
-	open_combo = False
-	for k in m:
-		if k == key_combo_seps['open']:
-			open_combo = True
+	if code == 503:
+		return make_response(jsonify(message="Busy: Macro '{0}' Dropped".format(macro)), 503)
+	# repeated 'press and hold' on a held macro has nothing to do
+	if job is None:
+		return jsonify(message='OK')
+	# client requested to return without waiting for the macro to run using ?async=true
+	if request.args.get('async', str(async_macros)).lower() == 'true':
+		return make_response(jsonify(url=url_for('select_job', job_id=job.id, _external=True)), 202, {'Location':url_for('select_job', job_id=job.id)})
+	job.done.wait()
+	if job.state in ['cancelled', 'preempted']:
+		return make_response(jsonify(message="{0}: Macro '{1}' Stopped Before It Finished".format(job.state.title(), macro)), 409)
+	if job.state != 'done':
+		abort(500)
+	return jsonify(message='OK')
+
+# runs list of macros of one profile back to back, ie {"macros":["gear up", {"macro":"flaps", "hold":true},
+# {"macro":"throttle", "release":true, "gap":0.5}]}. items can press and hold, only release a held macro, or
+# add a gap in seconds before the next item. every item is checked before any is queued, and all are queued at once
+# so macros of other clients can not run in between unless the queue policy orders them first.
+@app.route('/profiles/<name>/_batch', methods=['POST'])
+def batch_macros(name):
+	global async_macros, profiles, held_keys
+	if not authorized():
+		abort(401)
+	if name not in profiles:
+		abort(404)
+	body = request.get_json(silent=True)
+	items = body.get('macros') if isinstance(body, dict) else None
+	if not isinstance(items, list) or not items:
+		return make_response(jsonify(message="Invalid Batch: Expecting Object with List of 'macros'"), 400)
+	batch = []
+	errors = []
+	for i, item in enumerate(items):
+		if isinstance(item, basestring):
+			item = {'macro':item}
+		if not isinstance(item, dict) or not isinstance(item.get('macro'), basestring):
+			errors.append({'index':i, 'macro':None, 'message':"Invalid Item: Expecting Macro Name or Object with 'macro'"})
 			continue
-		if k == key_combo_seps['close']:
-			open_combo = False
-		if open_combo:
-			combo.append(key_codes[k])
+		macro = item['macro']
+		if not find_program(name, macro):
+			errors.append({'index':i, 'macro':macro, 'message':"Not Found: Macro '{0}' in Profile '{1}'".format(macro, name)})
+		gap = item.get('gap', 0)
+		if isinstance(gap, bool) or not isinstance(gap, (int, long, float)) or gap < 0:
+			errors.append({'index':i, 'macro':macro, 'message':"Invalid Item: 'gap' for Macro '{0}' Must Be a Number of Seconds".format(macro)})
+		if item.get('hold') and item.get('release'):
+			errors.append({'index':i, 'macro':macro, 'message':"Invalid Item: 'hold' and 'release' Both Set for Macro '{0}'".format(macro)})
+		batch.append((i, macro, bool(item.get('hold')), bool(item.get('release')), gap))
+	if errors:
+		return make_response(jsonify(message=errors[0]['message'], errors=errors), 400)
+	client = client_name()
+	results = []
+	# queued jobs are numbered so only the first can be dropped, the rest are dropped with it
+	queued = 0
+	dropped = False
+	with held_keys.lock:
+		for i, macro, hold, release, gap in batch:
+			if not dropped:
+				code, job = dispatch_macro(name, macro, client, hold, release, gap, queued)
+				dropped = code == 503
+			if dropped:
+				code, job = 503, None
+			elif job is not None:
+				queued += 1
+			results.append((i, macro, code, job))
+	# client requested to return without waiting for the macros to run using ?async=true
+	wait_for_jobs = request.args.get('async', str(async_macros)).lower() != 'true'
+	r = []
+	for i, macro, code, job in results:
+		if job is None:
+			r.append({'index':i, 'macro':macro, 'state':'dropped' if code == 503 else 'skipped'})
 			continue
-		if combo:
-			press_keys(key_duration, combo, press, release)
-			combo = []
-		else:
-			press_keys(key_duration, [key_codes[k]], press, release)
-		time.sleep(key_duration)
-	return jsonify(message='OK')
+		if wait_for_jobs:
+			job.done.wait()
+		d = job.to_dict()
+		d.update(index=i, url=url_for('select_job', job_id=job.id, _external=True))
+		r.append(d)
+	if not wait_for_jobs:
+		return make_response(jsonify(message='OK', results=r), 202)
+	return jsonify(message='OK', results=r)
+
+# keys currently held down. DELETE releases all of them, or only those held by a client using ?client=<name>
+@app.route('/held', methods=['GET','DELETE'])
+def held_list():
+	global held_keys
+	if not authorized():
+		abort(401)
+	if request.method == 'DELETE':
+		release_held(request.args.get('client'))
+		return make_response('', 204)
+	return jsonify(held_keys.to_dict())
+
+# input scheduler queue depth and wait times with URLs of recent jobs.
+@app.route('/jobs')
+def job_list():
+	global jobs, jobs_lock, scheduler
+	if not authorized():
+		abort(401)
+	r = scheduler.report()
+	with jobs_lock:
+		recent = jobs.values()
+	r['jobs'] = {j.id:{'url':url_for('select_job', job_id=j.id, _external=True), 'state':j.state} for j in recent}
+	return jsonify(r)
+
+# state of queued, running and recently finished macro executions. DELETE cancels a queued or running macro,
+# releasing any keys it pressed.
+@app.route('/jobs/<int:job_id>', methods=['GET','DELETE'])
+def select_job(job_id):
+	global jobs, jobs_lock, scheduler
+	if not authorized():
+		abort(401)
+	with jobs_lock:
+		job = jobs.get(job_id)
+	if job is None:
+		abort(404)
+	if request.method == 'DELETE':
+		if not scheduler.cancel(job):
+			return make_response(jsonify(message="Conflict: Job {0} is {1}".format(job.id, job.state.title()), job=job.to_dict()), 409)
+		job.done.wait()
+	return jsonify(job.to_dict())
 
 # list all valid key codes.
 @app.route('/key_codes')
@@ -300,15 +1882,246 @@ def select_key_codes():
 	# client requested to download a copy of the key codes file using /key_codes?send_file=true
 	if request.args.get('send_file', '').lower() == 'true':
 		return send_file(StringIO.StringIO(json.dumps(key_codes, **json_args)), as_attachment=True, attachment_filename='key_codes.json')
-	return jsonify(key_codes)
+	return cached_response(cached_resource(('key_codes',), lambda: key_codes))
+
+
+# persistent macro channel next to the HTTP service for clients that press buttons often. the TCP channel
+# is a line protocol, client authenticates once with 'AUTH <name> <auth_key>' and then sends frames of
+# '<op> <profile> <macro>' with url-quoted names. ops are X to execute, H to press and hold and R to release
+# a held macro. every frame is answered with 'OK [job id]' or 'ERR <code>' as soon as the macro is queued.
+# UDP datagrams are fire-and-forget frames prefixed with the credentials, '<name> <auth_key> <op> <profile> <macro>'.
+channel_ops = {'X':{}, 'H':{'hold':True}, 'R':{'release_only':True}}
+
+# queues macro for one channel frame, returns reply line.
+def channel_frame(line, client, address=None):
+	global held_keys, clients
+	parts = line.split()
+	if len(parts) != 3 or parts[0] not in channel_ops:
+		return 'ERR 400'
+	held_keys.touch(client)
+	clients.touch(client, address, size=len(line))
+	try:
+		name, macro = [urllib.unquote(x).decode('utf-8') for x in parts[1:]]
+	except UnicodeDecodeError:
+		return 'ERR 400'
+	code, job = dispatch_macro(name, macro, client, **channel_ops[parts[0]])
+	if code != 200:
+		return 'ERR {0}'.format(code)
+	return 'OK {0}'.format(job.id) if job else 'OK'
 
+class ChannelHandler(SocketServer.StreamRequestHandler):
+	disable_nagle_algorithm = True
+
+	def handle(self):
+		global logger_name
+		parts = self.rfile.readline().split()
+		if len(parts) != 3 or parts[0] != 'AUTH' or 'execute' not in (credential_scopes(parts[1], parts[2]) or ()):
+			self.wfile.write('ERR 401\n')
+			return
+		client = parts[1]
+		logging.getLogger(logger_name).info("Channel Opened: '{0}' from {1}".format(client, self.client_address[0]))
+		self.wfile.write('OK\n')
+		while True:
+			line = self.rfile.readline()
+			if not line:
+				break
+			self.wfile.write(channel_frame(line, client, self.client_address[0]) + '\n')
+		logging.getLogger(logger_name).info("Channel Closed: '{0}' from {1}".format(client, self.client_address[0]))
+		return
+
+class ChannelDatagramHandler(SocketServer.BaseRequestHandler):
+	def handle(self):
+		parts = self.request[0].split(None, 2)
+		if len(parts) == 3 and 'execute' in (credential_scopes(parts[0], parts[1]) or ()):
+			channel_frame(parts[2], parts[0], self.client_address[0])
+		return
+
+class ChannelServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+# starts TCP and UDP macro channels on port in background threads.
+def start_channel(ip, port):
+	servers = [ChannelServer((ip, port), ChannelHandler), SocketServer.UDPServer((ip, port), ChannelDatagramHandler)]
+	for s in servers:
+		t = threading.Thread(target=s.serve_forever, name='channel-' + s.__class__.__name__)
+		t.daemon = True
+		t.start()
+	return servers
+
+# production HTTP service. connections are kept alive with HTTP/1.1 but only hold a worker from the fixed
+# pool while a request is being served. between requests they are parked with a poller thread that hands
+# them back to the workers once the next request arrives, or closes them after sitting idle too long.
+class KeepAliveRequestHandler(WSGIRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	# headers and body go out in separate writes, without this the body waits on the client's delayed ack
+	disable_nagle_algorithm = True
+
+	# sets up handler for connection without serving it, requests are served one at a time with serve_one().
+	@classmethod
+	def open(cls, request, client_address, server):
+		h = cls.__new__(cls)
+		h.request = request
+		h.client_address = client_address
+		h.server = server
+		h.timeout = server.keep_alive_timeout
+		h.setup()
+		return h
+
+	# request body is read through a stream limited to its length, so what the view left unread can be
+	# skipped before the next request. bodies without a length can not be skipped, the connection is closed.
+	def make_environ(self):
+		environ = WSGIRequestHandler.make_environ(self)
+		try:
+			length = int(environ.get('CONTENT_LENGTH') or 0)
+		except ValueError:
+			length = -1
+		if length < 0 or 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+			self.body = None
+		else:
+			self.body = environ['wsgi.input'] = LimitedStream(self.rfile, length)
+		return environ
+
+	# serves one request, returns whether the connection stays open.
+	def serve_one(self):
+		self.close_connection = 1
+		self.body = False
+		try:
+			self.handle_one_request()
+			if not self.close_connection:
+				self.skip_body()
+		except (socket.error, socket.timeout) as e:
+			self.connection_dropped(e)
+			self.close_connection = 1
+		return not self.close_connection
+
+	# reads the rest of the request body so it is not parsed as the next request. large leftovers are not
+	# worth reading, the connection is closed instead.
+	def skip_body(self):
+		if self.body is False:
+			return
+		if self.body is None or self.body.limit - self.body.tell() > max_skipped_body:
+			self.close_connection = 1
+			return
+		try:
+			self.body.exhaust()
+		except ClientDisconnected:
+			self.close_connection = 1
+		if self.body.tell() < self.body.limit:
+			self.close_connection = 1
+		return
+
+	# next request was already read into the buffer along with the last one.
+	def pipelined(self):
+		rbuf = getattr(self.rfile, '_rbuf', None)
+		return rbuf is not None and rbuf.tell() > 0
+
+# bytes of a request body left unread by the view that are read and discarded to keep the connection open.
+max_skipped_body = 1024 * 1024
+
+class PooledWSGIServer(BaseWSGIServer):
+	multithread = True
+
+	def __init__(self, host, port, app, workers=16, backlog=64, keep_alive_timeout=15):
+		# listen backlog must be set before the socket is bound and activated
+		self.request_queue_size = backlog
+		self.keep_alive_timeout = keep_alive_timeout
+		BaseWSGIServer.__init__(self, host, port, app, handler=KeepAliveRequestHandler)
+		self.ready = Queue.Queue(maxsize=backlog)
+		self.idle = {}
+		self.idle_lock = threading.Lock()
+		# datagram to self wakes the poller when a connection is parked, select() on windows only takes sockets
+		self.wake = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.wake.bind(('127.0.0.1', 0))
+		threads = [threading.Thread(target=self.work, name='http-worker-{0}'.format(i)) for i in xrange(workers)]
+		threads.append(threading.Thread(target=self.poll, name='http-poller'))
+		for t in threads:
+			t.daemon = True
+			t.start()
+
+	# hands accepted connection to the pool, blocks accepting when the pool is backed up.
+	def process_request(self, request, client_address):
+		self.ready.put((request, client_address, None))
+		return
+
+	# serves requests of a connection until it has none waiting, then parks it. a request that was already
+	# read along with the last one is served right away, queueing it again could block on a full queue.
+	def work(self):
+		while True:
+			request, client_address, handler = self.ready.get()
+			try:
+				if handler is None:
+					handler = KeepAliveRequestHandler.open(request, client_address, self)
+				while handler.serve_one():
+					if not handler.pipelined():
+						self.park(request, client_address, handler)
+						break
+				else:
+					self.close(request, handler)
+			except Exception:
+				self.handle_error(request, client_address)
+				self.shutdown_request(request)
+
+	def park(self, request, client_address, handler):
+		with self.idle_lock:
+			self.idle[request] = (client_address, handler, time.time())
+		self.wake.sendto('x', self.wake.getsockname())
+		return
+
+	def close(self, request, handler):
+		try:
+			handler.finish()
+		except socket.error:
+			pass
+		self.shutdown_request(request)
+		return
+
+	# hands parked connections with a request waiting back to the workers. connections are taken out of idle
+	# under the lock but queued after it is released, workers parking connections need the lock to go on
+	# taking connections from a full queue.
+	def poll(self):
+		while True:
+			with self.idle_lock:
+				idle = self.idle.keys()
+			readable = select.select(idle + [self.wake], [], [], 1.0)[0]
+			now = time.time()
+			ready = []
+			with self.idle_lock:
+				for request in readable:
+					if request is self.wake:
+						self.wake.recv(64)
+						continue
+					client_address, handler, since = self.idle.pop(request)
+					ready.append((request, client_address, handler))
+				expired = [(r, self.idle.pop(r)[1]) for r, (a, h, since) in self.idle.items() if now - since > self.keep_alive_timeout]
+			for r in ready:
+				self.ready.put(r)
+			for request, handler in expired:
+				self.close(request, handler)
+
+# runs the HTTP service until shutdown with the werkzeug development server or the pooled production
+# server, then lets queued macros finish and releases held keys.
+def serve(host, port):
+	global http_server, server_mode, http_workers, http_backlog, keep_alive_timeout
+	if server_mode == 'production':
+		http_server = PooledWSGIServer(host, port, app, http_workers, http_backlog, keep_alive_timeout)
+		http_server.serve_forever()
+	else:
+		app.run(threaded=True, host=host, port=port)
+	drain_and_release()
+	return
 
 def setup():
 	global app_version, api_version
-	global status, clients, auth_key
-	global key_codes, key_duration, key_combo_seps
-	global profiles, profiles_db, json_args
-	global KEYEVENTF, held_macros
+	global status, clients, api_keys, sessions
+	global key_codes, key_duration, key_gap, key_combo_seps, valid_tokens
+	global key_index, key_scancodes, key_down, key_up, key_steps
+	global profiles, programs, profiles_db, json_args, lazy_profiles
+	global profiles_lock, journal_entries, journal_limit
+	global resource_cache, cached_hosts, cache_lock, metrics
+	global KEYEVENTF, held_keys, key_backend
+	global scheduler, jobs, jobs_lock, job_ids, max_jobs, async_macros, client_priorities
+	global http_server, server_mode, http_workers, http_backlog, keep_alive_timeout
 	global logger_name
 
 	# set locale to user preference
@@ -318,16 +2131,36 @@ def setup():
 		'ip':'0.0.0.0',
 		'port':5000,
 		'auth_key':generate_auth_key(),
+		'auth_keys':{},
+		'session_timeout':3600,
+		'max_clients':256,
+		'client_timeout':86400,
 		'profiles_db':'profiles.json',
 		'key_duration':0.025,
-		'key_combo_seps':{'open':'[', 'close':']'}
+		'key_gap':None,
+		'timer_spin':0.002,
+		'preempt_macros':False,
+		'key_combo_seps':{'open':'[', 'close':']'},
+		'key_backend':'sendinput' if sys.platform == 'win32' else 'null',
+		'async_macros':False,
+		'queue_policy':'fifo',
+		'client_priorities':{},
+		'hold_timeout':300,
+		'channel_port':0,
+		'server_mode':'development',
+		'http_workers':16,
+		'http_backlog':64,
+		'keep_alive_timeout':15,
+		'lazy_profiles':False
 	}
 
 	json_args = {'indent':4, 'separators':(',',':'), 'sort_keys':True}
 
 	# create log, set to rotate at 1MB
 	logger_name = 'werkzeug'
-	log_file = os.path.abspath(os.path.expandvars('$APPDATA/pyRESTvk-server/server.log'))
+	# %APPDATA% only exists on windows, fall back to home directory elsewhere
+	appdata = os.environ.get('APPDATA', os.path.expanduser('~'))
+	log_file = os.path.abspath(os.path.join(appdata, 'pyRESTvk-server', 'server.log'))
 	mkpath(os.path.dirname(log_file))
 	h = logging.handlers.RotatingFileHandler(filename=log_file, maxBytes=1024*1024, backupCount=9)
 	h.setLevel(logging.INFO)
@@ -337,7 +2170,7 @@ def setup():
 	l.info('-' * 25 + ' ' + datetime.datetime.now().strftime('%c') + ' ' + '-' * 25)
 
 	# search for settings in %APPDATA% first
-	settings_file = os.path.abspath(os.path.expandvars('$APPDATA/pyRESTvk-server/settings.json'))
+	settings_file = os.path.abspath(os.path.join(appdata, 'pyRESTvk-server', 'settings.json'))
 	# commandline args relative to current working directory
 	if len(sys.argv) == 2:
 		settings_file = os.path.abspath(os.path.join(os.getcwd(), os.path.expandvars(sys.argv[1])))
@@ -353,9 +2186,9 @@ def setup():
 	with open(settings_file) as f:
 		settings = json.load(f)
 
-	# check all needed settings keys exist, add missing settings
+	# check all needed settings keys exist, add missing settings. settings with a null default may stay null
 	for k in defaults:
-		if k not in settings or not settings[k]:
+		if k not in settings or (defaults[k] is not None and (settings[k] is None or settings[k] == '')):
 			l.warning("Key Not Found: Adding '{0}' to '{1}'".format(k, settings_file))
 			settings[k] = defaults[k]
 			with open(settings_file, 'w') as f:
@@ -372,26 +2205,114 @@ def setup():
 			'api':api_version
 		},
 		'server':{
-			'name':socket.getfqdn(),
-			'address':socket.gethostbyname(socket.getfqdn()),
+			'name':socket.gethostname(),
+			'address':settings['ip'],
 			'port':settings['port'],
 			'up-since':datetime.datetime.now().strftime('%c')
 		}
 	}
 
-	clients = {}
+	# registry of recently seen clients, idle ones are dropped unless client_timeout is 0
+	clients = ClientRegistry(settings['max_clients'], settings['client_timeout'], lambda: invalidate_resources(('status',)))
+	if settings['client_timeout'] > 0:
+		t = threading.Thread(target=sweep_clients, name='client-sweeper')
+		t.daemon = True
+		t.start()
 
-	auth_key = settings['auth_key']
+	# auth_key may do everything, auth_keys maps further keys to the scope they grant
+	api_keys = [(settings['auth_key'], auth_scopes['edit'])]
+	for key, scope in sorted(settings['auth_keys'].iteritems()):
+		if scope not in auth_scopes:
+			l.error("Error: Unknown Scope: '{0}' in '{1}'".format(scope, settings_file))
+			sys.exit(1)
+		api_keys.append((key, auth_scopes[scope]))
+	sessions = Sessions(settings['session_timeout'])
 	# flags used by keybd_event
 	KEYEVENTF = namedtuple('KEYBDINPUT_FLAGS', 'KEYDOWN, EXTENDEDKEY, KEYUP, UNICODE, SCANCODE')(*[int(2**x) for x in xrange(-1,4)])
 	key_codes = read_key_codes(os.path.abspath(os.path.join(os.path.dirname(sys.argv[0]), 'key_codes.json')))
+	key_index, key_scancodes, key_down, key_up, key_steps = intern_key_codes(key_codes)
 	key_duration = settings['key_duration']
+	# gap between keys defaults to key duration
+	key_gap = key_duration if settings['key_gap'] is None else settings['key_gap']
 	key_combo_seps = settings['key_combo_seps']
-	held_macros = []
+	valid_tokens = frozenset(key_codes) | frozenset([key_combo_seps['open'], key_combo_seps['close']])
+	held_keys = HeldKeys()
+	# select key injection backend
+	if settings['key_backend'] not in key_backends:
+		l.error("Error: Unknown Key Backend: '{0}' in '{1}'".format(settings['key_backend'], settings_file))
+		sys.exit(1)
+	try:
+		key_backend = key_backends[settings['key_backend']]()
+	except RuntimeError as e:
+		l.error("Error: Key Backend Unavailable: '{0}': {1}".format(settings['key_backend'], e))
+		sys.exit(1)
+
+	# input scheduler owns the keyboard, macros are queued to it from the request threads
+	async_macros = settings['async_macros']
+	client_priorities = settings['client_priorities']
+	if settings['queue_policy'] not in queue_policies:
+		l.error("Error: Unknown Queue Policy: '{0}' in '{1}'".format(settings['queue_policy'], settings_file))
+		sys.exit(1)
+	jobs = OrderedDict()
+	jobs_lock = threading.Lock()
+	job_ids = itertools.count(1)
+	max_jobs = 100
+	scheduler = InputScheduler(key_backend, held_keys, settings['queue_policy'], PrecisionTimer(settings['timer_spin']), settings['preempt_macros'])
+	scheduler.start()
+	atexit.register(release_held_at_exit)
+	# release keys held by clients that went away, disabled with hold_timeout of 0
+	if settings['hold_timeout'] > 0:
+		t = threading.Thread(target=sweep_held_keys, args=(settings['hold_timeout'],), name='held-key-sweeper')
+		t.daemon = True
+		t.start()
+	# HTTP service settings, http_server is only set once the production server is started
+	http_server = None
+	if settings['server_mode'] not in ['development', 'production']:
+		l.error("Error: Unknown Server Mode: '{0}' in '{1}'".format(settings['server_mode'], settings_file))
+		sys.exit(1)
+	server_mode = settings['server_mode']
+	http_workers = settings['http_workers']
+	http_backlog = settings['http_backlog']
+	keep_alive_timeout = settings['keep_alive_timeout']
+
+	resource_cache = {}
+	cached_hosts = OrderedDict()
+	cache_lock = threading.RLock()
+	metrics = Metrics()
 
 	# key_.* globals must be populated before profiles can be loaded
 	profiles_db = settings['profiles_db']
-	profiles = read_profiles(profiles_db)
+	lazy_profiles = settings['lazy_profiles']
+	profiles_lock = threading.RLock()
+	journal_limit = 100
+	if lazy_profiles:
+		# profiles are read, validated and compiled on first use. journal is kept until it reaches journal_limit
+		# records, compacting now would read every profile.
+		profiles = LazyProfiles(profiles_db)
+		atexit.register(profiles.save)
+		journal_entries = 0
+		if os.path.isfile(profiles_db + '.journal'):
+			with open(profiles_db + '.journal') as f:
+				journal_entries = sum(1 for line in f)
+		programs = {}
+	else:
+		profiles = read_profiles(profiles_db)
+		# fold journal left by the previous run into a fresh snapshot
+		journal_entries = 1 if os.path.isfile(profiles_db + '.journal') else 0
+		if journal_entries:
+			compact_profiles()
+		programs = {k:compile_profile(p) for k, p in profiles.iteritems()}
+
+	# persistent macro channel, disabled with channel_port of 0. started last since frames are served as
+	# soon as it listens
+	if settings['channel_port']:
+		start_channel(settings['ip'], settings['channel_port'])
+
+	# reverse DNS can stall for seconds, start up only waits resolve_timeout seconds for the server name
+	t = threading.Thread(target=resolve_server_name, name='name-resolver')
+	t.daemon = True
+	t.start()
+	t.join(resolve_timeout)
 
 	# dump status info to console
 	print json.dumps(status, **json_args)
@@ -401,4 +2322,4 @@ def setup():
 
 if __name__ == '__main__':
 	kwargs = setup()
-	app.run(threaded=True, **kwargs)
+	serve(**kwargs)
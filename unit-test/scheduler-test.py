@@ -0,0 +1,217 @@
+# pyRESTvk/unit-test/scheduler-test.py
+# Dan Allongo (daniel.s.allongo@gmail.com)
+
+# Checks the key events the input scheduler sends, on any machine. The server is set up in-process
+# with the 'recording' key backend and a throwaway settings file, macros are run through the flask
+# test client and the recorded batches of key events are compared with what the macros should send.
+
+import os
+import sys
+import json
+import time
+import base64
+import tempfile
+
+here = os.path.dirname(os.path.abspath(sys.argv[0]))
+sys.path.insert(0, os.path.join(here, '..'))
+
+# server is configured from a throwaway settings file so the user's profiles are never touched
+work_dir = tempfile.mkdtemp(prefix='pyRESTvk-scheduler-test-')
+os.environ['APPDATA'] = work_dir
+settings_file = os.path.join(work_dir, 'settings.json')
+password = 'scheduler-test'
+with open(settings_file, 'w') as f:
+	json.dump({'auth_key':password, 'key_backend':'recording', 'key_duration':0, 'profiles_db':'profiles.json', 'hold_timeout':0, 'client_timeout':0}, f)
+sys.argv = [os.path.join(here, '..', 'server.py'), settings_file]
+import server
+server.setup()
+
+auth = {'Authorization':'Basic ' + base64.b64encode('scheduler-test:' + password)}
+client = server.app.test_client()
+backend = server.key_backend
+test_profile = {'scheduler-test':{'combo':'[ lctrl lshift a ]', 'ctrl a':'[ lctrl a ]', 'ctrl b':'[ lctrl b ]', 'ctrl':'lctrl', 'wait':'a ~500 b', 'hold wait':'a@500 ~500 b', 'a':'a', 'b':'b'}}
+r = client.post('/profiles', data=json.dumps(test_profile), content_type='application/json', headers=auth)
+assert r.status_code == 201
+
+def sc(k):
+	return server.key_codes[k]['sc']
+
+def down(*keys):
+	return [(sc(k), server.key_down[server.key_index[k]]) for k in keys]
+
+def up(*keys):
+	return [(sc(k), server.key_up[server.key_index[k]]) for k in keys]
+
+# runs macro and returns the batches of key events it sent.
+def run(macro, params=''):
+	backend.reset()
+	r = client.get('/profiles/scheduler-test/' + macro + '?async=false' + params, headers=auth)
+	assert r.status_code == 200
+	server.scheduler.drain()
+	return backend.batches
+
+# verify a combo is pressed in one batch and released in one batch, in order
+assert run('combo') == [down('lctrl', 'lshift', 'a'), up('lctrl', 'lshift', 'a')]
+print 'combo OK'
+
+# verify overlapping holds only press keys that are not down yet
+assert run('ctrl%20a', '&hold=true') == [down('lctrl', 'a')]
+assert run('ctrl%20b', '&hold=true') == [down('b')]
+# verify a plain macro does not release a key that is held
+assert run('ctrl') == [down('lctrl')]
+# verify a key shared by holds is only released by the last one
+assert run('ctrl%20a', '&release=true') == [up('a')]
+assert run('ctrl%20b', '&release=true') == [up('lctrl', 'b')]
+assert server.held_keys.to_dict() == {'macros':[], 'keys':[]}
+print 'held keys OK'
+
+def post(profile):
+	return client.post('/profiles', data=json.dumps(profile), content_type='application/json', headers=auth).status_code
+
+journal = server.profiles_db + '.journal'
+# verify a change the journal cannot record is not made live
+os.rename(journal, journal + '.saved')
+os.mkdir(journal)
+assert post({'journal-failed':{'a':'a'}}) == 500
+assert 'journal-failed' not in server.profiles
+os.rmdir(journal)
+os.rename(journal + '.saved', journal)
+# verify a torn last record is dropped on replay and changes committed after it survive
+assert post({'journal-a':{'a':'a'}}) == 201
+with open(journal, 'ab') as f:
+	f.write('{"put":{"journal-torn":{"a":')
+replayed = server.LazyProfiles(server.profiles_db)
+assert 'journal-a' in replayed and 'journal-torn' not in replayed
+replayed.close()
+assert post({'journal-b':{'b':'b'}}) == 201
+replayed = server.LazyProfiles(server.profiles_db)
+assert sorted(k for k in replayed if k.startswith('journal-')) == ['journal-a', 'journal-b']
+replayed.close()
+assert sorted(k for k in server.read_profiles(server.profiles_db) if k.startswith('journal-')) == ['journal-a', 'journal-b']
+print 'journal OK'
+
+# verify names of the resources under /profiles are refused for profiles and macros
+r = client.post('/profiles?validate_only=true', data=json.dumps({'_bulk':{'a':'a'}, 'names':{'_batch':'a'}}), content_type='application/json', headers=auth)
+assert r.status_code == 400
+assert sorted((e['profile'], e['macro'], e['position']) for e in json.loads(r.data)['errors']) == [('_bulk', None, 0), ('names', '_batch', 0)]
+assert post({'_bulk':{'a':'a'}}) == 400
+print 'reserved names OK'
+
+# waits for the first key event of a macro that is running.
+def started(events, timeout=5):
+	deadline = time.time() + timeout
+	while not events:
+		assert time.time() < deadline
+		time.sleep(0.001)
+	return
+
+# verify cancelling a running macro releases the key it pressed, whether it is still down or not, and
+# presses nothing after
+for macro in ['wait', 'hold%20wait']:
+	backend.reset()
+	r = client.get('/profiles/scheduler-test/' + macro + '?async=true', headers=auth)
+	assert r.status_code == 202
+	started(backend.batches)
+	r = client.delete('/jobs/' + json.loads(r.data)['url'].rsplit('/', 1)[1], headers=auth)
+	assert r.status_code == 200 and json.loads(r.data)['state'] == 'cancelled'
+	server.scheduler.drain()
+	assert backend.batches == [down('a'), up('a')]
+print 'cancel OK'
+
+# runs batch and returns the response with its body.
+def batch(items, params=''):
+	r = client.post('/profiles/scheduler-test/_batch' + params, data=json.dumps({'macros':items}), content_type='application/json', headers=auth)
+	return r.status_code, json.loads(r.data)
+
+# verify a batch runs every item in order under each policy, repeated items are not coalesced or dropped
+for policy in ['drop', 'coalesce', 'fifo']:
+	server.scheduler.policy = policy
+	backend.reset()
+	code, body = batch(['a', 'b', 'a', 'a'])
+	assert code == 200 and [i['state'] for i in body['results']] == ['done'] * 4
+	assert backend.batches == [down('a'), up('a'), down('b'), up('b')] + [down('a'), up('a')] * 2
+# verify a batch sent while the scheduler is busy under drop is dropped as a whole
+server.scheduler.policy = 'drop'
+backend.reset()
+r = client.get('/profiles/scheduler-test/hold%20wait?async=true', headers=auth)
+started(backend.batches)
+code, body = batch(['a', 'b', 'a'])
+assert code == 200 and [i['state'] for i in body['results']] == ['dropped'] * 3
+client.delete('/jobs/' + json.loads(r.data)['url'].rsplit('/', 1)[1], headers=auth)
+server.scheduler.drain()
+assert backend.batches == [down('a'), up('a')]
+server.scheduler.policy = 'fifo'
+# verify a batch with an invalid item queues nothing
+backend.reset()
+submitted = server.scheduler.report()['submitted']
+code, body = batch(['a', 'missing', 'b'])
+assert code == 400 and body['errors'][0]['index'] == 1
+server.scheduler.drain()
+assert backend.batches == [] and server.scheduler.report()['submitted'] == submitted
+print 'batch OK'
+
+# verify a preempting job stops the running one, releasing its key, and runs before jobs queued earlier
+preempting = server.InputScheduler(server.RecordingBackend(), server.HeldKeys(), 'fifo', preempt=True)
+preempting.start()
+def job(m, priority=0):
+	return server.MacroJob(0, 'scheduler-test', m, server.compile_macro(m), 0.001, priority=priority)
+running = preempting.submit(job('a@500'))
+started(preempting.backend.batches)
+queued = [preempting.submit(job('b')), preempting.submit(job('c'))]
+urgent = preempting.submit(job('d', 1))
+for j in [running, urgent] + queued:
+	j.done.wait()
+assert running.state == 'preempted' and urgent.started < queued[0].started
+assert preempting.backend.batches == [down('a'), up('a'), down('d'), up('d'), down('b'), up('b'), down('c'), up('c')]
+preempting.stop()
+preempting.join()
+print 'preempt OK'
+
+r = client.delete('/profiles/scheduler-test', headers=auth)
+assert r.status_code == 204
+server.scheduler.stop()
+server.scheduler.join()
+
+# scheduler on a virtual clock, events are recorded at their deadlines without sleeping
+timer = server.VirtualTimer(0.0)
+backend = server.RecordingBackend(timer.now)
+scheduler = server.InputScheduler(backend, server.HeldKeys(), 'fifo', timer)
+scheduler.start()
+
+# runs macro with key duration and gap in seconds, returns events as (seconds from start, key, 'down' or 'up')
+def timed(m, duration=0.025, gap=0.005):
+	backend.reset()
+	program = m if isinstance(m, server.MacroProgram) else server.compile_macro(m)
+	job = scheduler.submit(server.MacroJob(0, 'scheduler-test', 'timed', program, duration, gap=gap))
+	job.done.wait()
+	assert job.state == 'done'
+	names = {v['sc']:k for k, v in server.key_codes.iteritems()}
+	return [(round(t - job.started, 6), names[sc], 'up' if f & server.KEYEVENTF.KEYUP else 'down') for t, sc, f in backend.events]
+
+# verify per token timing with repeats holds 40 ms and waits 10 ms after each
+assert timed('a@40,10*3') == [(0.0, 'a', 'down'), (0.04, 'a', 'up'), (0.05, 'a', 'down'), (0.09, 'a', 'up'), (0.1, 'a', 'down'), (0.14, 'a', 'up')]
+# verify a wait delays the next key by 250 ms after the gap of the key before it
+assert timed('a@40 ~250 b@40') == [(0.0, 'a', 'down'), (0.04, 'a', 'up'), (0.29, 'b', 'down'), (0.33, 'b', 'up')]
+# verify macro object timing overrides the key duration and gap of the job
+assert timed({'keys':'a b', 'key_duration':0.02, 'key_gap':0.03}) == [(0.0, 'a', 'down'), (0.02, 'a', 'up'), (0.05, 'b', 'down'), (0.07, 'b', 'up')]
+# verify plain macros use the key duration and gap of the job
+assert timed('a b') == [(0.0, 'a', 'down'), (0.025, 'a', 'up'), (0.03, 'b', 'down'), (0.055, 'b', 'up')]
+assert scheduler.report()['jitter']['max'] == 0.0
+print 'timing OK'
+
+# verify a reference expands in place, repeated as often as given
+programs = server.compile_profile({'outer':'a &inner*2 d', 'inner':'[ b c ]', 'ref':'&key', 'key':'lctrl'})
+assert timed(programs['outer']) == [(0.0, 'a', 'down'), (0.025, 'a', 'up'),
+	(0.03, 'b', 'down'), (0.03, 'c', 'down'), (0.055, 'b', 'up'), (0.055, 'c', 'up'),
+	(0.06, 'b', 'down'), (0.06, 'c', 'down'), (0.085, 'b', 'up'), (0.085, 'c', 'up'),
+	(0.09, 'd', 'down'), (0.115, 'd', 'up')]
+# verify a reference to a single key can still be held, a macro of several steps can not
+assert programs['ref'].holdable and not programs['outer'].holdable
+# verify references back to a macro being expanded and expansions past max_macro_steps are refused
+assert [e['message'].split(':')[0] for e in server.profile_errors('refs', {'a':'x &b', 'b':'&a'})] == ['Invalid Reference']
+errors = server.profile_errors('refs', {'x':'a*100', 'y':'&x*{0}'.format(server.max_macro_steps // 100 + 1)})
+assert [(e['macro'], e['message'].split(':')[0]) for e in errors] == [('y', 'Macro Too Long')]
+assert not server.profile_errors('refs', {'x':'a*100', 'y':'&x*{0}'.format(server.max_macro_steps // 100)})
+print 'references OK'
+scheduler.stop()
+scheduler.join()
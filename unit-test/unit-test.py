@@ -15,7 +15,7 @@ import copy
 server_ip = '127.0.0.1'
 server_port = 5000
 # testing for this API version
-api_version = '2.1'
+api_version = '2.2'
 # pass hostname as username
 username = platform.node()
 # http password
@@ -46,6 +46,18 @@ s.auth=(username,password)
 r = s.get(base_url + '/auth')
 assert r.status_code == 200
 print r.json()['message']
+# verify session token issued on registration authenticates in place of the password
+token, expires = r.json()['token'], r.json()['expires']
+r = requests.get(base_url + '/held', headers={'Authorization':'Bearer ' + token})
+assert r.status_code == 200
+# verify a token issued for a token does not outlive it
+r = requests.get(base_url + '/auth', headers={'Authorization':'Bearer ' + token})
+assert r.status_code == 200
+assert r.json()['expires'] <= expires
+r = requests.get(base_url + '/held', auth=(username, token))
+assert r.status_code == 200
+r = requests.get(base_url + '/held', auth=(username, token + '0'))
+assert r.status_code == 401
 # dump server status to console
 r = s.get(base_url)
 assert r.status_code == 200
@@ -56,7 +68,7 @@ r = s.get(clients_url)
 assert r.status_code == 200
 print r.text
 # find test client in list
-assert username in r.json()
+assert username in [c['name'] for c in r.json()['clients']]
 # get server status for profiles URL
 r = s.get(base_url)
 assert r.status_code == 200
@@ -98,6 +110,10 @@ r = s.get(profile_url)
 assert r.status_code == 200
 print r.text
 assert test_profile == r.json()
+# verify conditional GET of unchanged profile
+etag = r.headers['etag']
+r = s.get(profile_url, headers={'If-None-Match':etag})
+assert r.status_code == 304
 # verify POST not allowed
 r = s.post(profile_url)
 assert r.status_code == 405
@@ -138,8 +154,12 @@ assert r.status_code == 200
 r = s.post(profiles_url, json=test_profile)
 assert r.status_code == 409
 print r.json()['message']
+# verify update refused when client copy is out of date
+r = s.put(profile_url, json=test_profile, headers={'If-Match':'"out-of-date"'})
+assert r.status_code == 412
+print r.json()['message']
 # update profile same name
-r = s.put(profile_url, json=test_profile)
+r = s.put(profile_url, json=test_profile, headers={'If-Match':etag})
 assert r.status_code == 204
 # verify profile syntax validation on update
 r = s.put(profile_url, json=test_profile_bad)